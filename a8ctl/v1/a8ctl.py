@@ -21,10 +21,13 @@ import argparse
 import os
 import sys
 
-import commands # implementation of cli commands
-#import commands_GREMLINaaS as commands # implementation of cli commands
+import batch
+
+def build_parser():
+    # Imported here so that thin daemon clients (see main) do not pay for importing the commands
+    import commands # implementation of cli commands
+    #import commands_GREMLINaaS as commands # implementation of cli commands
 
-def main():
     parser = argparse.ArgumentParser('a8ctl', description="""
     Query and manipulate the Amalgam8 Microservice Fabric Controller to manage microservice routing rules or inject failures and delays.
     """,
@@ -67,6 +70,22 @@ def main():
     parser.add_argument('--a8-log-server',
                         help='override $A8_LOG_SERVER with log server for Amalgam8 log messages',
                         default=os.getenv('A8_LOG_SERVER', 'localhost:30200'))
+
+    parser.add_argument('--timeout',
+                        help='override $A8_TIMEOUT with the number of seconds to wait for each Amalgam8 service to respond (default is 30)',
+                        type=float,
+                        default=float(os.getenv('A8_TIMEOUT', '30')))
+
+    parser.add_argument('--cache-dir',
+                        help='override $A8_CACHE_DIR with a directory for caching list command responses (no caching by default)',
+                        default=os.getenv('A8_CACHE_DIR', ''))
+    parser.add_argument('--cache-ttl',
+                        help='override $A8_CACHE_TTL with the number of seconds to reuse a cached response that cannot be revalidated',
+                        type=float,
+                        default=float(os.getenv('A8_CACHE_TTL', '10')))
+    parser.add_argument('--no-cache',
+                        help='ignore $A8_CACHE_DIR and --cache-dir, and always fetch fresh responses',
+                        action='store_true')
     
     subparsers = parser.add_subparsers(help='', # 2nd column heading over subcommand name
                                        dest='subparser_name',
@@ -86,6 +105,13 @@ def main():
     parser_service_list.add_argument("--json",
                                      help='Output services in JSON format', 
                                      action='store_true')
+    parser_service_list.add_argument("--ndjson",
+                                     help='Output services as newline-delimited JSON, writing each one as soon as it is available',
+                                     action='store_true')
+    parser_service_list.add_argument("--concurrency",
+                                     help='Maximum number of concurrent requests to the Amalgam8 Registry (default is 10)',
+                                     type=int,
+                                     default=10)
     parser_service_list.set_defaults(func=commands.service_list)
 
     # a8ctl route-list
@@ -97,6 +123,9 @@ def main():
     parser_service_routing.add_argument("--json",
                                         help='Output routes in JSON format', 
                                         action='store_true')
+    parser_service_routing.add_argument("--ndjson",
+                                        help='Output routes as newline-delimited JSON, writing each one as soon as it is available',
+                                        action='store_true')
     parser_service_routing.set_defaults(func=commands.service_routing)
 
     # a8ctl route-set <service> [--default version] [--selector version(condition)]*
@@ -134,6 +163,9 @@ def main():
     parser_rules_list.add_argument("--json",
                                    help='Output injection rules in JSON format', 
                                    action='store_true')
+    parser_rules_list.add_argument("--ndjson",
+                                   help='Output injection rules as newline-delimited JSON, writing each one as soon as it is available',
+                                   action='store_true')
     parser_rules_list.set_defaults(func=commands.rules_list)
 
     # a8ctl rule-set ...
@@ -170,7 +202,11 @@ def main():
                               description='Clear all fault injection rules from the application (deprecated, use rule-delete).',
                               help='Clear all fault injection rules from the application (deprecated, use rule-delete).'
                               )
-    parser_clear_rules.set_defaults(func=commands.clear_rules)
+    parser_clear_rules.set_defaults(func=commands.clear_rules, service=None)
+    parser_clear_rules.add_argument("--concurrency",
+                                    help='Maximum number of concurrent requests to the Amalgam8 Controller (default is 10)',
+                                    type=int,
+                                    default=10)
 
     # a8ctl action-list
     parser_action_list = \
@@ -181,6 +217,9 @@ def main():
     parser_action_list.add_argument("--json",
                                    help='Output action rules in JSON format', 
                                    action='store_true')
+    parser_action_list.add_argument("--ndjson",
+                                    help='Output action rules as newline-delimited JSON, writing each one as soon as it is available',
+                                    action='store_true')
     parser_action_list.set_defaults(func=commands.action_list)
 
     # a8ctl action-add ...
@@ -203,13 +242,45 @@ def main():
     parser_add_action.add_argument("--priority",
                                   help='The priority of this rule')
 
+    # a8ctl plan -f <manifest>
+    parser_plan = \
+        subparsers.add_parser('plan',
+                              description='Show the changes that apply would make to the routing and action rules, without making them.',
+                              help='Show the rule changes needed to apply a manifest file.'
+                              )
+    parser_plan.set_defaults(func=commands.plan_rules)
+    parser_plan.add_argument("-f", "--file",
+                             required=True,
+                             help='Manifest file with "routes" and "actions" lists, in the format of the route-list and action-list JSON output')
+    parser_plan.add_argument("--prune",
+                             help='Also delete the rules of microservices missing from the routes or actions of the manifest',
+                             action='store_true')
+
+    # a8ctl apply -f <manifest>
+    parser_apply = \
+        subparsers.add_parser('apply',
+                              description='Set the routing and action rules of many microservices from a manifest file, changing only the microservices whose rules differ.',
+                              help='Set routing and action rules from a JSON or YAML manifest file.'
+                              )
+    parser_apply.set_defaults(func=commands.apply_rules)
+    parser_apply.add_argument("-f", "--file",
+                              required=True,
+                              help='Manifest file with "routes" and "actions" lists, in the format of the route-list and action-list JSON output')
+    parser_apply.add_argument("--prune",
+                              help='Also delete the rules of microservices missing from the routes or actions of the manifest',
+                              action='store_true')
+    parser_apply.add_argument("--concurrency",
+                              help='Maximum number of concurrent requests to the Amalgam8 Controller (default is 10)',
+                              type=int,
+                              default=10)
+
     # a8ctl action-clear
     parser_clear_actions = \
         subparsers.add_parser('action-clear',
                               description='Clear all action rules for a destination microservice.',
                               help='Clear all action rules for a destination microservice.'
                               )
-    parser_clear_actions.set_defaults(func=commands.clear_rules)
+    parser_clear_actions.set_defaults(func=commands.clear_rules, concurrency=1)
     parser_clear_actions.add_argument("service",
                                       help='The microservice name')
 
@@ -247,6 +318,14 @@ def main():
     parser_run_recipe.add_argument("--json",
                                    help='Output results in JSON format', 
                                    action='store_true')
+    parser_run_recipe.add_argument("--chunk-size",
+                                   help='Maximum number of failure rules to send to the Amalgam8 Controller in one request (default is 500)',
+                                   type=int,
+                                   default=500)
+    parser_run_recipe.add_argument("--concurrency",
+                                   help='Maximum number of concurrent requests to the Amalgam8 Controller (default is 4)',
+                                   type=int,
+                                   default=4)
 
     # a8ctl traffic-start <service> <version> [--amount <percent>]
     parser_traffic_start = \
@@ -287,8 +366,45 @@ def main():
     parser_traffic_abort.add_argument("service",
                                       help='The microservice name')
 
+    # a8ctl batch [-f <file>]
+    parser_batch = \
+        subparsers.add_parser('batch',
+                              description='Run a8ctl commands read one per line from a file or stdin, in a single process.',
+                              help='Run a8ctl commands read one per line from a file or stdin, in a single process.'
+                              )
+    parser_batch.set_defaults(func=lambda args: batch.run_batch(parser, args))
+    parser_batch.add_argument("-f", "--file",
+                              help='File of commands, e.g. "route-set reviews --default v1" (default is stdin)')
+    parser_batch.add_argument("--keep-going",
+                              help='Run the remaining commands after a command fails',
+                              action='store_true')
+
+    # a8ctl daemon [--socket <path>]
+    parser_daemon = \
+        subparsers.add_parser('daemon',
+                              description='Run a local daemon that executes a8ctl commands for clients with $A8_DAEMON_SOCKET set.',
+                              help='Run a local daemon that executes a8ctl commands for clients with $A8_DAEMON_SOCKET set.'
+                              )
+    parser_daemon.set_defaults(func=lambda args: batch.run_daemon(build_parser, args))
+    parser_daemon.add_argument("--socket",
+                               help='override $A8_DAEMON_SOCKET with the Unix socket to listen on (default is ~/.a8ctl.sock)',
+                               default=batch.default_socket_path())
+
+    return parser
+
+def main():
+    # With $A8_DAEMON_SOCKET set, hand the command to the daemon if one is listening,
+    # unless it can only run here (or has no subcommand, e.g. --help)
+    socket_path = os.getenv('A8_DAEMON_SOCKET')
+    command = batch.subcommand(sys.argv[1:])
+    if socket_path and command is not None and command not in batch.LOCAL_ONLY:
+        status = batch.run_remote(socket_path, sys.argv[1:])
+        if status is not None:
+            sys.exit(status)
+
+    parser = build_parser()
     args = parser.parse_args()
-    args.func(args)
+    batch.run_args(args)
     
 
 if __name__ == '__main__':
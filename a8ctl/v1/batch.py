@@ -0,0 +1,248 @@
+# Copyright 2016 IBM Corporation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Run many a8ctl commands in one process, either from a batch file or sent by
+# thin clients to a long-lived local daemon over a Unix socket.
+
+import sys
+import os
+import copy
+import json
+import shlex
+import socket
+import threading
+import traceback
+
+NOT_BATCHABLE = ['batch', 'daemon']
+
+# Commands that thin clients always run themselves: recipe-run waits for the user to inject load
+LOCAL_ONLY = NOT_BATCHABLE + ['recipe-run']
+
+# The global options of a8ctl (see build_parser) that take no value. All the others take one.
+GLOBAL_FLAGS = ['-h', '--help', '--debug', '--no-cache']
+
+def exit_status(e):
+    """Return the process exit status for a SystemExit"""
+    if e.code is None:
+        return 0
+    if isinstance(e.code, int):
+        return e.code
+    sys.stderr.write(str(e.code) + "\n")
+    return 1
+
+def run_args(args):
+    """Run the command selected by parsed command line args"""
+    import session # imported here to keep the thin client path of a8ctl free of requests
+    session.set_timeout(args.timeout)
+    args.func(args)
+
+def run_command(parser, argv, defaults=None):
+    """
+    Parse and run one a8ctl command line from a batch or a daemon client.
+    @param defaults: argparse.Namespace supplying the global options the command line does not set
+    @return: the exit status of the command
+    """
+    try:
+        args = parser.parse_args(argv, copy.copy(defaults))
+        if args.subparser_name in NOT_BATCHABLE:
+            sys.stderr.write("a8ctl: {0} cannot be run from a batch or by the daemon\n".format(args.subparser_name))
+            return 1
+        run_args(args)
+    except SystemExit, e:
+        return exit_status(e)
+    return 0
+
+def run_batch(parser, args):
+    """Run the a8ctl command on each line of args.file (stdin by default), stopping at the first failure"""
+    if args.file and args.file != '-':
+        if not os.path.isfile(args.file):
+            print u"Batch file {} not found".format(args.file)
+            sys.exit(4)
+        fp = open(args.file)
+    else:
+        fp = sys.stdin
+
+    failures = 0
+    with fp:
+        for lineno, line in enumerate(fp, 1):
+            argv = shlex.split(line, comments=True)
+            if not argv:
+                continue
+            status = run_command(parser, argv, args)
+            sys.stdout.flush()
+            if status != 0:
+                sys.stderr.write("a8ctl batch: line {0} failed with exit status {1}: {2}\n".format(lineno, status, line.strip()))
+                if not args.keep_going:
+                    sys.exit(status)
+                failures += 1
+    if failures:
+        sys.exit(3)
+
+############################################
+# Daemon
+############################################
+
+def default_socket_path():
+    return os.getenv('A8_DAEMON_SOCKET', os.path.expanduser('~/.a8ctl.sock'))
+
+def subcommand(argv):
+    """Return the subcommand of an a8ctl command line, after its global options, or None if there is none"""
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if not arg.startswith('-'):
+            return arg
+        # argparse accepts unambiguous prefixes of long options, such as --deb for --debug
+        if '=' not in arg and not any(flag.startswith(arg) for flag in GLOBAL_FLAGS):
+            i += 1 # the value of the option
+        i += 1
+    return None
+
+def _a8_environ():
+    return dict((key, value) for key, value in os.environ.iteritems() if key.startswith('A8_'))
+
+# The daemon protocol: the client sends its request as a JSON line, followed by its stdin,
+# and shuts down its side of the socket at the end of its stdin. The daemon sends back
+# JSON lines: {"stdout": text} and {"stderr": text} as the command writes them, then {"status": n}.
+
+class _StreamWriter(object):
+    """A file-like object that sends whatever is written to it to a daemon client"""
+
+    def __init__(self, wfile, name, lock):
+        self._wfile = wfile
+        self._name = name
+        self._lock = lock
+
+    def write(self, data):
+        if not data:
+            return
+        if not isinstance(data, unicode):
+            data = data.decode('utf-8', 'replace')
+        with self._lock:
+            try:
+                self._wfile.write(json.dumps({self._name: data}) + "\n")
+            except socket.error:
+                pass # the client went away, but the command still runs to the end
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+def _serve_request(build_parser, request, rfile, wfile):
+    """
+    Run one client command line with the client's working directory and A8_* environment,
+    reading the client's stdin from rfile and streaming its output to wfile
+    """
+    saved_cwd, saved_env = os.getcwd(), _a8_environ()
+    saved_stdio = sys.stdin, sys.stdout, sys.stderr
+    lock = threading.Lock()
+    sys.stdin = rfile
+    sys.stdout, sys.stderr = _StreamWriter(wfile, "stdout", lock), _StreamWriter(wfile, "stderr", lock)
+    status = 1
+    try:
+        for key in saved_env:
+            del os.environ[key]
+        os.environ.update(request.get("env", {}))
+        os.chdir(request.get("cwd", saved_cwd))
+        # The parser defaults come from the environment, so build it for each client
+        status = run_command(build_parser(), request["argv"])
+    except Exception:
+        traceback.print_exc()
+    finally:
+        sys.stdin, sys.stdout, sys.stderr = saved_stdio
+        for key in _a8_environ():
+            del os.environ[key]
+        os.environ.update(saved_env)
+        os.chdir(saved_cwd)
+    return status
+
+def run_daemon(build_parser, args):
+    """Serve a8ctl commands sent by thin clients on a Unix socket, one at a time, until interrupted"""
+    import SocketServer
+    import signal
+
+    class Handler(SocketServer.StreamRequestHandler):
+        def handle(self):
+            request = json.loads(self.rfile.readline())
+            if args.debug:
+                print "daemon:", " ".join(request["argv"])
+            status = _serve_request(build_parser, request, self.rfile, self.wfile)
+            self.wfile.write(json.dumps({"status": status}) + "\n")
+
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    server = SocketServer.UnixStreamServer(args.socket, Handler)
+    os.chmod(args.socket, 0600)
+    print "a8ctl daemon listening on", args.socket
+    sys.stdout.flush()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+
+def _send_stdin(client):
+    """Copy stdin to the daemon as it arrives, then tell the daemon it has ended"""
+    try:
+        while True:
+            data = os.read(sys.stdin.fileno(), 65536)
+            if not data:
+                break
+            client.sendall(data)
+        client.shutdown(socket.SHUT_WR)
+    except (socket.error, OSError, ValueError):
+        pass # the command is over, or there is no stdin to forward
+
+def run_remote(socket_path, argv):
+    """
+    Send a command line to the daemon listening on socket_path, with stdin, and print its output as it comes.
+    @return: the exit status of the command, or None if no daemon is listening
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except socket.error:
+        return None
+    request = {"argv": argv, "cwd": os.getcwd(), "env": _a8_environ()}
+    client.sendall(json.dumps(request) + "\n")
+    # The daemon reads stdin only if the command does, so it is copied in the background
+    stdin_thread = threading.Thread(target=_send_stdin, args=(client,))
+    stdin_thread.daemon = True
+    stdin_thread.start()
+
+    status = 1
+    responses = client.makefile('r')
+    for line in iter(responses.readline, ''):
+        response = json.loads(line)
+        if "status" in response:
+            status = response["status"]
+            break
+        for name, text in response.iteritems():
+            stream = getattr(sys, name)
+            stream.write(text.encode('utf-8'))
+            stream.flush()
+    else:
+        sys.stderr.write("a8ctl: the daemon closed the connection before the command finished\n")
+    responses.close()
+    client.close()
+    return status
@@ -0,0 +1,108 @@
+# Copyright 2016 IBM Corporation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# On-disk cache of GET responses from the Amalgam8 Controller and Registry
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+DEFAULT_TTL = 10 # seconds
+
+class CachedResponse(object):
+    """A cached GET response, as stored in a ResponseCache"""
+
+    def __init__(self, path, entry):
+        self.path = path
+        self.entry = entry
+
+    def is_fresh(self, ttl):
+        return time.time() - self.entry["time"] < ttl
+
+    def headers(self):
+        # Stored as a plain dict; servers differ on case (Go sends "Etag")
+        return CaseInsensitiveDict(self.entry["headers"])
+
+    def validators(self):
+        """Return the conditional request headers needed to revalidate this response"""
+        stored = self.headers()
+        headers = {}
+        if "ETag" in stored:
+            headers["If-None-Match"] = stored["ETag"]
+        if "Last-Modified" in stored:
+            headers["If-Modified-Since"] = stored["Last-Modified"]
+        return headers
+
+    def to_response(self):
+        r = requests.Response()
+        r.url = self.entry["url"]
+        r.status_code = self.entry["status_code"]
+        r.headers = self.headers()
+        r.encoding = get_encoding_from_headers(r.headers)
+        r._content = self.entry["content"].encode('latin-1')
+        return r
+
+class ResponseCache(object):
+    """
+    Cache of successful GET responses, one file per url and token.
+    Responses carrying an ETag or Last-Modified header are revalidated with a
+    conditional request on every use; other responses are reused for ttl seconds.
+    """
+
+    def __init__(self, directory, ttl=DEFAULT_TTL):
+        self.directory = os.path.expanduser(directory)
+        self.ttl = ttl
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 0700)
+
+    def _path(self, url, headers):
+        key = hashlib.sha1(url + "\n" + headers.get('Authorization', '')).hexdigest()
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, url, headers):
+        """Return the CachedResponse for url, or None if there is none"""
+        path = self._path(url, headers)
+        try:
+            with open(path) as fp:
+                return CachedResponse(path, json.load(fp))
+        except (IOError, ValueError):
+            return None
+
+    def put(self, url, headers, response):
+        """Store a 200 response to a GET of url"""
+        entry = {
+            "url": url,
+            "time": time.time(),
+            "status_code": response.status_code,
+            "headers": dict(response.headers),
+            "content": response.content.decode('latin-1')
+        }
+        self._write(CachedResponse(self._path(url, headers), entry))
+
+    def refresh(self, cached):
+        """Mark a cached response as just revalidated"""
+        cached.entry["time"] = time.time()
+        self._write(cached)
+
+    def _write(self, cached):
+        # Write to a temporary file first so that concurrent readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(cached.entry, fp)
+        os.rename(tmp_path, cached.path)
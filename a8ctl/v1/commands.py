@@ -15,17 +15,16 @@
 # Implementation of Amalgam8 CLI functions
 
 import sys
-import requests
 import json
-import sets
-from urlparse import urlparse
-from prettytable import PrettyTable
 import os
-import urllib
 import datetime, time
-import pprint
+from collections import Counter, deque
+from itertools import islice, izip
 from parse import compile
-from gremlin import ApplicationGraph, A8FailureGenerator, A8AssertionChecker
+from session import get_session, get_timeout
+from cache import ResponseCache
+# prettytable, multiprocessing and gremlin (networkx, elasticsearch) are slow to import,
+# so they are imported only by the functions that need them.
 
 def passOrfail(result):
     if result:
@@ -33,18 +32,29 @@ def passOrfail(result):
     else:
         return "FAIL"
 
-def a8_get(url, token, headers={'Accept': 'application/json'}, showcurl=False, extra_headers={}):
+def a8_get(url, token, headers={'Accept': 'application/json'}, showcurl=False, extra_headers={}, cache=None):
+    """
+    @type cache: ResponseCache
+    """
+    headers = dict(headers) # never modify the shared default
     if token != "" :
         headers['Authorization'] = "Bearer " + token
     if extra_headers:
         headers=dict(headers.items() + extra_headers.items())
 
+    cached = cache.get(url, headers) if cache else None
+    if cached and not cached.validators() and cached.is_fresh(cache.ttl):
+        if showcurl:
+            print "cached", url
+        return cached.to_response()
+    request_headers = dict(headers.items() + cached.validators().items()) if cached else headers
+
     if showcurl:
-        curl_headers = ' '.join(["-H '{0}: {1}'".format(key, value) for key, value in headers.iteritems()])
+        curl_headers = ' '.join(["-H '{0}: {1}'".format(key, value) for key, value in request_headers.iteritems()])
         print "curl", curl_headers, url
 
     try:
-        r = requests.get(url, headers=headers)
+        r = get_session().get(url, headers=request_headers, timeout=get_timeout())
     except Exception, e:
         sys.stderr.write("Could not contact {0}".format(url))
         sys.stderr.write("\n")
@@ -52,6 +62,12 @@ def a8_get(url, token, headers={'Accept': 'application/json'}, showcurl=False, e
         sys.stderr.write("\n")
         sys.exit(2)
 
+    if cached and r.status_code == 304:
+        cache.refresh(cached)
+        r = cached.to_response()
+    elif cache and r.status_code == 200:
+        cache.put(url, headers, r)
+
     if showcurl:
         print r.text
 
@@ -61,6 +77,7 @@ def a8_post(url, token, body, headers={'Accept': 'application/json', 'Content-ty
     """
     @type body: str
     """
+    headers = dict(headers) # never modify the shared default
     if token != "" :
         headers['Authorization'] = "Bearer " + token
     if extra_headers:
@@ -71,7 +88,7 @@ def a8_post(url, token, body, headers={'Accept': 'application/json', 'Content-ty
         print "REQ:", "curl -i -X POST", url, curl_headers, "--data", '\'{0}\''.format(body.replace('\'', '\\\''))
 
     try:
-        r = requests.post(url, headers=headers, data=body)
+        r = get_session().post(url, headers=headers, data=body, timeout=get_timeout())
     except Exception, e:
         sys.stderr.write("Could not POST to {0}".format(url))
         sys.stderr.write("\n")
@@ -90,6 +107,7 @@ def a8_put(url, token, body, headers={'Accept': 'application/json', 'Content-typ
     @type body: str
     """
 
+    headers = dict(headers) # never modify the shared default
     if token != "" :
         headers['Authorization'] = "Bearer " + token
     if extra_headers:
@@ -100,7 +118,7 @@ def a8_put(url, token, body, headers={'Accept': 'application/json', 'Content-typ
         print "REQ:", "curl -i -X PUT", url, curl_headers, "--data", '\'{0}\''.format(body.replace('\'', '\\\''))
 
     try:
-        r = requests.put(url, headers=headers, data=body)
+        r = get_session().put(url, headers=headers, data=body, timeout=get_timeout())
     except Exception, e:
         sys.stderr.write("Could not PUT to {0}".format(url))
         sys.stderr.write("\n")
@@ -115,6 +133,7 @@ def a8_put(url, token, body, headers={'Accept': 'application/json', 'Content-typ
     return r
 
 def a8_delete(url, token, headers={'Accept': 'application/json'}, showcurl=False, extra_headers={}):
+    headers = dict(headers) # never modify the shared default
     if token != "" :
         headers['Authorization'] = "Bearer " + token
     if extra_headers:
@@ -125,7 +144,7 @@ def a8_delete(url, token, headers={'Accept': 'application/json'}, showcurl=False
         print "curl -X DELETE", curl_headers, url
 
     try:
-        r = requests.delete(url, headers=headers)
+        r = get_session().delete(url, headers=headers, timeout=get_timeout())
     except Exception, e:
         sys.stderr.write("Could not DELETE {0}".format(url))
         sys.stderr.write("\n")
@@ -135,6 +154,75 @@ def a8_delete(url, token, headers={'Accept': 'application/json'}, showcurl=False
 
     return r
 
+def parallel_imap(func, items, concurrency=1):
+    """
+    Yield func(item) for each item, running up to concurrency calls at a time.
+    Results are yielded in the order of items, each as soon as it is available.
+    Items are taken lazily, and a call is only started once an earlier result has been
+    consumed, so at most concurrency results are held however slow the consumer is.
+    If a call exits (e.g., through fail_unless), the exit is re-raised in the calling thread.
+    """
+    items = iter(items)
+    first = list(islice(items, concurrency))
+    if len(first) <= 1:
+        for item in first:
+            yield func(item)
+        for item in items:
+            yield func(item)
+        return
+
+    def call(item):
+        try:
+            return None, func(item)
+        except SystemExit, e:
+            return e, None
+
+    from multiprocessing.pool import ThreadPool
+    get_session(concurrency) # one pooled connection per worker
+    pool = ThreadPool(len(first))
+    try:
+        pending = deque(pool.apply_async(call, (item,)) for item in first)
+        while pending:
+            # get() with a timeout keeps the main thread responsive to Ctrl-C
+            exit, result = pending.popleft().get(sys.maxint)
+            if exit:
+                raise exit
+            for item in islice(items, 1):
+                pending.append(pool.apply_async(call, (item,)))
+            yield result
+    finally:
+        pool.terminate()
+
+def parallel_map(func, items, concurrency=1):
+    """Return [func(item) for item in items], running up to concurrency calls at a time"""
+    return list(parallel_imap(func, items, concurrency))
+
+def print_entries(args, entries, columns, row):
+    """
+    Print the entries of a list command as NDJSON (--ndjson), JSON (--json), or a table.
+    In NDJSON mode each entry is written as soon as it is produced, without collecting them first.
+    @param row: function returning the table row for an entry
+    """
+    if args.ndjson:
+        for entry in entries:
+            sys.stdout.write(json.dumps(entry) + "\n")
+            sys.stdout.flush()
+    elif args.json:
+        print json.dumps(list(entries), indent=2)
+    else:
+        from prettytable import PrettyTable
+        x = PrettyTable(columns)
+        x.align = "l"
+        for entry in entries:
+            x.add_row(row(entry))
+        print x
+
+def get_cache(args):
+    """Return the ResponseCache selected by the command line, or None if caching is off"""
+    if args.no_cache or not args.cache_dir:
+        return None
+    return ResponseCache(args.cache_dir, args.cache_ttl)
+
 def get_field(d, key):
     if key not in d:
         return '***MISSING***'
@@ -148,15 +236,89 @@ def fail_unless(response, code_or_codes):
         print response.text
         sys.exit(3)
 
-def is_active(service, default_version, registry_url, registry_token, debug=False):
-    r = a8_get('{0}/api/v1/services/{1}'.format(registry_url, service), registry_token, showcurl=debug)
-    if r.status_code == 200:
-        instance_list = r.json()["instances"]
+class RegistrySnapshot(object):
+    """
+    In-memory view of the services and instances in the Amalgam8 Registry.
+    Each service is fetched from the registry at most once, and its instances
+    are indexed by (service, version) for all later lookups.
+    """
+
+    def __init__(self, registry_url, registry_token, debug=False, concurrency=1, cache=None):
+        self.registry_url = registry_url
+        self.registry_token = registry_token
+        self.debug = debug
+        self.concurrency = concurrency
+        self.cache = cache
+        self._services = None
+        self._versions = {}  # service -> list of versions, in registry order
+        self._instances = {} # (service, version) -> list of instances
+
+    def _fetch_instances(self, service):
+        r = a8_get('{0}/api/v1/services/{1}'.format(self.registry_url, service), self.registry_token,
+                   showcurl=self.debug, cache=self.cache)
+        if r.status_code == 404: # unknown, or deregistered since the service list was fetched
+            return []
+        fail_unless(r, 200)
+        return r.json()["instances"]
+
+    def _add_instances(self, service, instance_list):
+        versions = []
         for instance in instance_list:
-            version = version = tags_to_version(instance.get("tags"))
-            if version == default_version:
-                return True
-    return False
+            version = tags_to_version(instance.get("tags"))
+            if (service, version) not in self._instances:
+                self._instances[(service, version)] = []
+                versions.append(version)
+            self._instances[(service, version)].append(instance)
+        self._versions[service] = versions
+
+    def services(self):
+        """Return the names of all registered services"""
+        if self._services is None:
+            r = a8_get('{0}/api/v1/services'.format(self.registry_url), self.registry_token,
+                       showcurl=self.debug, cache=self.cache)
+            fail_unless(r, 200)
+            self._services = r.json()["services"]
+        return self._services
+
+    def load(self):
+        """Fetch the instances of every registered service not already in the snapshot"""
+        for service in self.iter_load():
+            pass
+        return self
+
+    def iter_instances(self):
+        """
+        Yield (service, instances) for every registered service, in registry order, as soon as
+        its instances are fetched. The instances are not kept in the snapshot.
+        """
+        services = self.services()
+        return izip(services, parallel_imap(self._fetch_instances, services, self.concurrency))
+
+    def iter_load(self):
+        """Like load, but yield each service, in registry order, as soon as its instances are in the snapshot"""
+        missing = [service for service in self.services() if service not in self._versions]
+        fetched = parallel_imap(self._fetch_instances, missing, self.concurrency)
+        for service in self.services():
+            if service not in self._versions:
+                self._add_instances(service, fetched.next())
+            yield service
+
+    def versions(self, service):
+        """Return the versions of service that have registered instances"""
+        if service not in self._versions:
+            self._add_instances(service, self._fetch_instances(service))
+        return self._versions[service]
+
+    def instances(self, service, version):
+        """Return the registered instances of the given service version"""
+        self.versions(service)
+        return self._instances.get((service, version), [])
+
+def is_active(registry, service, version):
+    """
+    @type registry: RegistrySnapshot
+    """
+    return len(registry.instances(service, version)) > 0
 
 def base_route_rule(destination, version, priority):
     rule = {
@@ -292,18 +454,9 @@ def get_match_selector(version, match, weight=None):
     selector += ")"
     return selector 
 
-def add_rule(sorted_rules, rule):
-    for i in range(0, len(sorted_rules)):
-        if sorted_rules[i]["priority"] < rule["priority"]:
-            sorted_rules.insert(i, rule)
-            return
-    sorted_rules.append(rule)
-    
 def sort_rules(rule_list):
-    sorted_rules = []
-    for rule in rule_list:
-        add_rule(sorted_rules, rule)
-    return sorted_rules
+    """Return the rules by decreasing priority, keeping the original order of rules with equal priority"""
+    return sorted(rule_list, key=lambda rule: rule["priority"], reverse=True)
             
 def get_routes(routing_rules):
     default = None
@@ -330,87 +483,20 @@ def get_routes(routing_rules):
     return default, selectors
                          
 NO_VERSION = "-untagged-"
+
+# route-list status of a service
+ROUTED = "routed"             # has routing rules and is registered
+UNREGISTERED = "unregistered" # has routing rules but is not registered
+UNROUTED = "unrouted"         # is registered but has no routing rules
 SELECTOR_PARSER = compile("{version}({rule})")
 ACTION_PARSER = compile("{version}({weight}->{action}={value})")
 
-############################################
-# CLI Commands
-############################################
-
-def service_list(args):
-    registry_url, registry_token = args.a8_registry_url, args.a8_registry_token
-    r = a8_get('{0}/api/v1/services'.format(registry_url), registry_token, showcurl=args.debug)
-    fail_unless(r, 200)
-    service_list = r.json()["services"]
-    result_list = []
-    for service in service_list:
-        r = a8_get('{0}/api/v1/services/{1}'.format(registry_url, service), registry_token, showcurl=args.debug)
-        fail_unless(r, 200)
-        instance_list = r.json()["instances"]
-        version_counts = {}
-        for instance in instance_list:
-            version = tags_to_version(instance.get("tags"))
-            version_counts[version] = version_counts.get(version, 0) + 1
-        result_instances = []
-        for version, count in version_counts.iteritems():
-            result_instances.append("%s(%s)" % (version, count))
-        result_list.append({"service": service, "instances": result_instances})
-    if args.json:
-        print json.dumps(result_list, indent=2)
-    else:
-        x = PrettyTable(["Service", "Instances"])
-        x.align = "l"
-        for entry in result_list:
-            service = entry["service"]
-            versions = ", ".join(entry["instances"])
-            x.add_row([service, versions])
-        print x
-
-def service_routing(args):
-    r = a8_get('{0}/v1/rules/routes'.format(args.a8_controller_url),
-                args.a8_controller_token,
-                showcurl=args.debug)
-    fail_unless(r, 200)
-    service_rules = r.json()["services"]
-    registry_url, registry_token = args.a8_registry_url, args.a8_registry_token
-    r = a8_get('{0}/api/v1/services'.format(registry_url), registry_token, showcurl=args.debug)
-    fail_unless(r, 200)
-    service_list = r.json()["services"]
-    #service_rules = { "reviews": test_routing_rules, "ratings": test_routing_rules2 } #FB TEMP
-    #service_list = [ "foo" ] #FB TEMP
-
-    result_list = []
-    for service, routing_rules in service_rules.iteritems():
-        if service in service_list:
-            service_list.remove(service)
-        default, selectors = get_routes(routing_rules)
-        if selectors:
-            result_list.append({"service": service, "default": default, "selectors": selectors})
-        else:
-            result_list.append({"service": service, "default": default})
-    for service in service_list:
-        result_list.append({"service": service})
-    if args.json:
-        print json.dumps(result_list, indent=2)
-    else:
-        x = PrettyTable(["Service", "Default Version", "Version Selectors"])
-        x.align = "l"
-        for entry in result_list:
-            x.add_row([entry["service"],
-                       entry["default"] if "default" in entry else "",
-                       ", ".join(entry["selectors"]) if "selectors" in entry else ""
-                       ])
-        print x
-
-def set_routing(args):
-    if not args.default:
-         print "You must specify --default"
-         sys.exit(4)
-
+def route_rules(service, default, selectors=None, source=None):
+    """Return the routing rules of service for a default version and a list of version(condition) selectors"""
     weight_list = []
     header_list = []
-    if args.selector:
-        for selector in args.selector:
+    if selectors:
+        for selector in selectors:
             r = SELECTOR_PARSER.parse(selector)
             if not r:
                 print "Invalid --selector value: %s" % selector
@@ -433,17 +519,250 @@ def set_routing(args):
                 sys.exit(6)
 
     priority = 1
-    if args.source:
-        routing_request = { "rules": [ weight_rule(args.service, args.default, [], priority) ] }
+    if source:
+        rules = [ weight_rule(service, default, [], priority) ]
         priority += 1
-        routing_request["rules"].insert(0, weight_rule(args.service, args.default, weight_list, priority, args.source))
+        rules.insert(0, weight_rule(service, default, weight_list, priority, source))
     else:
-        routing_request = { "rules": [ weight_rule(args.service, args.default, weight_list, priority) ] }
+        rules = [ weight_rule(service, default, weight_list, priority) ]
 
     for version, header, pattern in header_list:
         priority += 1
-        routing_request["rules"].insert(0, header_rule(args.service, version, header, pattern, priority, args.source))
-    
+        rules.insert(0, header_rule(service, version, header, pattern, priority, source))
+    return rules
+
+def match_headers(headers=None, cookies=None):
+    """Return the match headers for a list of {header}:{pattern} and {key}={value} cookie filters, or None if there are none"""
+    if not headers and not cookies:
+        return None
+    match = {}
+    if headers:
+        for header in headers:
+            key, sep, value = header.partition(':')
+            match[key] = value
+    if cookies:
+        for cookie in cookies:
+            match['Cookie'] = '.*?'+cookie
+    return match
+
+def parse_actions(action_list):
+    """Return the rule actions for a list of {version}({weight}->{action}={value}) strings"""
+    actions = []
+    for action in action_list:
+        r = ACTION_PARSER.parse(action)
+        if not r:
+            print "Invalid --action value: %s" % action
+            sys.exit(6)
+        version = r['version'].strip()
+        weight = float(r['weight'].strip())
+        action_type = r['action'].strip()
+        value = r['value'].strip()
+        if action_type == 'delay':
+            rule_action = {
+                "action" : "delay",
+                "probability" : weight,
+                "duration": float(value),
+                "tags": version_to_tags(version)
+            }
+            actions.append(rule_action)
+        elif action_type == 'abort':
+            rule_action = {
+                "action" : "abort",
+                "probability" : weight,
+                "return_code": int(value),
+                "tags": version_to_tags(version)
+            }
+            actions.append(rule_action)
+        else:
+            print "Invalid --action type: %s" % action
+            sys.exit(7)
+    return actions
+
+def load_manifest(path):
+    """Return the desired rules read from a JSON or YAML (.yaml, .yml) manifest file"""
+    if not os.path.isfile(path):
+        print u"Manifest file {} not found".format(path)
+        sys.exit(4)
+    with open(path) as fp:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                print "PyYAML is required to read YAML manifests (pip install pyyaml)"
+                sys.exit(4)
+            manifest = yaml.safe_load(fp)
+        else:
+            manifest = json.load(fp)
+    if not isinstance(manifest, dict):
+        print u"Invalid manifest file {}: expected routes and/or actions".format(path)
+        sys.exit(5)
+    return manifest
+
+def manifest_rules(manifest):
+    """
+    Return the routing and action rules of a manifest as two lists of (destination, rules) pairs,
+    in the order the destinations first appear. Action rules without a priority are given
+    increasing priorities, in manifest order, above the other rules of their destination.
+    """
+    routes = []
+    route_services = set()
+    for entry in manifest.get("routes") or []:
+        service = entry.get("service")
+        if not service or not entry.get("default"):
+            print "Every routes entry must specify a service and a default version: %s" % json.dumps(entry)
+            sys.exit(5)
+        if service in route_services:
+            print "Duplicate routes entry for microservice %s" % service
+            sys.exit(5)
+        route_services.add(service)
+        routes.append((service, route_rules(service, entry["default"], entry.get("selectors"), entry.get("source"))))
+
+    actions = []
+    action_rules = {}
+    for entry in manifest.get("actions") or []:
+        destination = entry.get("destination")
+        if not destination or not (entry.get("source") or entry.get("headers") or entry.get("cookies")):
+            print "Every actions entry must specify a destination, and at least one source, headers, or cookies: %s" % json.dumps(entry)
+            sys.exit(5)
+        if not entry.get("actions"):
+            print "Every actions entry must specify at least one action: %s" % json.dumps(entry)
+            sys.exit(5)
+        if destination not in action_rules:
+            action_rules[destination] = []
+            actions.append((destination, action_rules[destination]))
+        rules = action_rules[destination]
+        if entry.get("priority") is not None:
+            priority = int(entry["priority"])
+        else:
+            priority = 10
+            for rule in rules:
+                if rule["priority"] >= priority:
+                    priority = rule["priority"] + 10
+        rules.append(action_rule(entry.get("source"),
+                                 destination,
+                                 match_headers(entry.get("headers"), entry.get("cookies")),
+                                 priority,
+                                 parse_actions(entry["actions"])))
+    return routes, actions
+
+# Duplicated from gremlin/failuregenerator_a8.py so that rule commands do not import gremlin
+def _hashable(value):
+    """Return a hashable equivalent of a JSON value, equal for equal values"""
+    if isinstance(value, dict):
+        return tuple(sorted((key, _hashable(item)) for key, item in value.iteritems()))
+    if isinstance(value, list):
+        return tuple(_hashable(item) for item in value)
+    return value
+
+def rules_equal(current, desired):
+    """Return True if two lists of rules are the same, ignoring rule ids and the order of the rules"""
+    if len(current) != len(desired):
+        return False
+    def rule_key(rule):
+        return _hashable(dict((key, value) for key, value in rule.iteritems() if key != "id"))
+    return Counter(rule_key(rule) for rule in current) == Counter(rule_key(rule) for rule in desired)
+
+def plan_changes(args, manifest):
+    """
+    Compare the rules in a manifest with the current rules of the Controller, fetched once.
+    With args.prune, the rules of destinations missing from a section of the manifest are deleted.
+    @return: the (method, path, rules, message) calls needed to apply the manifest,
+             and the number of destinations that are already up to date
+    """
+    routes, actions = manifest_rules(manifest)
+
+    def get_rules(kind):
+        r = a8_get('{0}/v1/rules/{1}'.format(args.a8_controller_url, kind),
+                   args.a8_controller_token,
+                   showcurl=args.debug)
+        fail_unless(r, 200)
+        return r.json()["services"]
+
+    current_routes, current_actions = parallel_map(get_rules, ["routes", "actions"], 2)
+
+    changes = []
+    unchanged = 0
+    for kind, desired, current, description in [("routes", routes, current_routes, "routing rules for microservice"),
+                                                ("actions", actions, current_actions, "action rules for destination")]:
+        for destination, rules in desired:
+            if rules_equal(current.get(destination, []), rules):
+                unchanged += 1
+            else:
+                changes.append(("PUT", "/v1/rules/{0}/{1}".format(kind, destination), rules,
+                                "Set {0} {1}".format(description, destination)))
+        if args.prune and kind in manifest:
+            desired_destinations = set(destination for destination, rules in desired)
+            for destination, rules in sorted(current.iteritems()):
+                if rules and destination not in desired_destinations:
+                    changes.append(("DELETE", "/v1/rules/{0}/{1}".format(kind, destination), [],
+                                    "Deleted {0} {1}".format(description, destination)))
+    return changes, unchanged
+
+############################################
+# CLI Commands
+############################################
+
+def service_list(args):
+    registry = RegistrySnapshot(args.a8_registry_url, args.a8_registry_token, args.debug, args.concurrency,
+                                get_cache(args))
+    def service_entries():
+        # Each service is counted and dropped, so --ndjson runs in constant memory
+        for service, instance_list in registry.iter_instances():
+            versions = []
+            counts = {}
+            for instance in instance_list:
+                version = tags_to_version(instance.get("tags"))
+                if version not in counts:
+                    counts[version] = 0
+                    versions.append(version)
+                counts[version] += 1
+            result_instances = ["%s(%s)" % (version, counts[version]) for version in versions]
+            yield {"service": service, "instances": result_instances}
+    print_entries(args, service_entries(),
+                  ["Service", "Instances"],
+                  lambda entry: [entry["service"], ", ".join(entry["instances"])])
+
+def service_routing(args):
+    cache = get_cache(args)
+    registry = RegistrySnapshot(args.a8_registry_url, args.a8_registry_token, args.debug, cache=cache)
+    def get_service_rules():
+        return a8_get('{0}/v1/rules/routes'.format(args.a8_controller_url),
+                      args.a8_controller_token,
+                      showcurl=args.debug,
+                      cache=cache)
+    # The controller and registry requests are independent, so issue them together
+    r, service_list = parallel_map(lambda fetch: fetch(), [get_service_rules, registry.services], 2)
+    fail_unless(r, 200)
+    service_rules = r.json()["services"]
+    #service_rules = { "reviews": test_routing_rules, "ratings": test_routing_rules2 } #FB TEMP
+    #service_list = [ "foo" ] #FB TEMP
+
+    registered = set(service_list)
+    def route_entries():
+        for service, routing_rules in service_rules.iteritems():
+            default, selectors = get_routes(routing_rules)
+            entry = {"service": service, "default": default}
+            if selectors:
+                entry["selectors"] = selectors
+            entry["status"] = ROUTED if service in registered else UNREGISTERED
+            yield entry
+        for service in service_list:
+            if service not in service_rules:
+                yield {"service": service, "status": UNROUTED}
+    print_entries(args, route_entries(),
+                  ["Service", "Default Version", "Version Selectors"],
+                  lambda entry: [entry["service"],
+                                 entry["default"] if "default" in entry else "",
+                                 ", ".join(entry["selectors"]) if "selectors" in entry else ""
+                                 ])
+
+def set_routing(args):
+    if not args.default:
+         print "You must specify --default"
+         sys.exit(4)
+
+    routing_request = { "rules": route_rules(args.service, args.default, args.selector, args.source) }
+
     #print json.dumps(routing_request, indent=2)
     r = a8_put('{0}/v1/rules/routes/{1}'.format(args.a8_controller_url, args.service),
                args.a8_controller_token,
@@ -463,64 +782,60 @@ def rules_list(args):
     sys.stderr.write("WARNING: deprecated command. Will be removed in the future. Use action-list instead.\n")
     r = a8_get('{0}/v1/rules/actions'.format(args.a8_controller_url),
                args.a8_controller_token,
-               showcurl=args.debug)
+               showcurl=args.debug,
+               cache=get_cache(args))
     fail_unless(r, 200)
     service_rules = r.json()["services"]
     #service_rules = { "ratings": test_fault_rules } #FB TEMP
 
-    result_list = []
-    for action_rules in service_rules.itervalues():
-        for rule in sort_rules(action_rules):
-            action_entry = {
-                "id": rule["id"],
-                "priority": rule["priority"]
-            }
-            if "match" in rule:
-                match = rule["match"]
-                if "source" in match:
-                    action_entry["source"] = versioned_service_name(match["source"]["name"], match["source"].get("tags"))
-                if "headers" in match:
-                    for header, pattern in match["headers"].iteritems():
-                        action_entry["header"] = header
-                        action_entry["header_pattern"] = pattern
-                        break # Ignore more than one header
-            tagged_destinations = set()
-            delay_set = False
-            abort_set = False
-            for action in rule["actions"]:
-                if action["action"] == "delay":
-                    if delay_set: continue # Ignore all but the first one.
-                    action_entry["delay"] = action["duration"]
-                    action_entry["delay_probability"] = action["probability"]
-                    tagged_destinations.add(versioned_service_name(rule["destination"], action.get("tags")))
-                    delay_set = True
-                elif action["action"] == "abort":
-                    if abort_set: continue # Ignore all but the first one.
-                    action_entry["abort_code"] = action["return_code"]
-                    action_entry["abort_probability"] = action["probability"]
-                    tagged_destinations.add(versioned_service_name(rule["destination"], action.get("tags")))
-                    abort_set = True
-                elif action["action"] == "trace":
-                    tagged_destinations.add(versioned_service_name(rule["destination"], action.get("tags")))
-            action_entry["destination"] = ",".join(tagged_destinations)
-            result_list.append(action_entry)
-    if args.json:
-        print json.dumps(result_list, indent=2)
-    else:
-        x = PrettyTable(["Source", "Destination", "Header", "Header Pattern", "Delay Probability", "Delay", "Abort Probability", "Abort Code", "Rule Id"])
-        x.align = "l"
-        for entry in result_list:
-            x.add_row([entry.get("source", ""),
-                       entry["destination"],
-                       entry.get("header", ""),
-                       entry.get("header_pattern", ""),
-                       entry.get("delay_probability", ""),
-                       entry.get("delay", ""),
-                       entry.get("abort_probability", ""),
-                       entry.get("abort_code", ""),
-                       entry["id"]
-            ])
-        print x
+    def action_entries():
+        for action_rules in service_rules.itervalues():
+            for rule in sort_rules(action_rules):
+                action_entry = {
+                    "id": rule["id"],
+                    "priority": rule["priority"]
+                }
+                if "match" in rule:
+                    match = rule["match"]
+                    if "source" in match:
+                        action_entry["source"] = versioned_service_name(match["source"]["name"], match["source"].get("tags"))
+                    if "headers" in match:
+                        for header, pattern in match["headers"].iteritems():
+                            action_entry["header"] = header
+                            action_entry["header_pattern"] = pattern
+                            break # Ignore more than one header
+                tagged_destinations = set()
+                delay_set = False
+                abort_set = False
+                for action in rule["actions"]:
+                    if action["action"] == "delay":
+                        if delay_set: continue # Ignore all but the first one.
+                        action_entry["delay"] = action["duration"]
+                        action_entry["delay_probability"] = action["probability"]
+                        tagged_destinations.add(versioned_service_name(rule["destination"], action.get("tags")))
+                        delay_set = True
+                    elif action["action"] == "abort":
+                        if abort_set: continue # Ignore all but the first one.
+                        action_entry["abort_code"] = action["return_code"]
+                        action_entry["abort_probability"] = action["probability"]
+                        tagged_destinations.add(versioned_service_name(rule["destination"], action.get("tags")))
+                        abort_set = True
+                    elif action["action"] == "trace":
+                        tagged_destinations.add(versioned_service_name(rule["destination"], action.get("tags")))
+                action_entry["destination"] = ",".join(tagged_destinations)
+                yield action_entry
+    print_entries(args, action_entries(),
+                  ["Source", "Destination", "Header", "Header Pattern", "Delay Probability", "Delay", "Abort Probability", "Abort Code", "Rule Id"],
+                  lambda entry: [entry.get("source", ""),
+                                 entry["destination"],
+                                 entry.get("header", ""),
+                                 entry.get("header_pattern", ""),
+                                 entry.get("delay_probability", ""),
+                                 entry.get("delay", ""),
+                                 entry.get("abort_probability", ""),
+                                 entry.get("abort_code", ""),
+                                 entry["id"]
+                                 ])
 
 def set_rule(args):
     sys.stderr.write("WARNING: deprecated command. Will be removed in the future. Use action-add instead.\n")
@@ -571,68 +886,77 @@ def set_rule(args):
 
 def clear_rules(args):
     sys.stderr.write("WARNING: deprecated command. Will be removed in the future. Use rule-delete instead.\n")
-    r = a8_get('{0}/v1/rules/actions'.format(args.a8_controller_url),
-               args.a8_controller_token,
-               showcurl=args.debug)
-    fail_unless(r, 200)
-    service_rules = r.json()["services"]
-    #service_rules = { "ratings": test_fault_rules } #FB TEMP
-
-    for destination in service_rules:
-        r = a8_delete('{0}/v1/rules/actions/{1}'.format(args.a8_controller_url, destination),
-                      args.a8_controller_token,
-                      showcurl=args.debug)
-    fail_unless(r, 200)
-    print 'Cleared fault injection rules from all microservices'
+    if args.service:
+        destinations = [ args.service ]
+    else:
+        r = a8_get('{0}/v1/rules/actions'.format(args.a8_controller_url),
+                   args.a8_controller_token,
+                   showcurl=args.debug)
+        fail_unless(r, 200)
+        destinations = r.json()["services"].keys()
+
+    def delete_actions(destination):
+        return a8_delete('{0}/v1/rules/actions/{1}'.format(args.a8_controller_url, destination),
+                         args.a8_controller_token,
+                         showcurl=args.debug)
+
+    failures = 0
+    for destination, r in zip(destinations, parallel_map(delete_actions, destinations, args.concurrency)):
+        if r.status_code != 200:
+            sys.stderr.write("Failed to clear action rules for destination {0}: {1} {2}\n".format(destination, r.status_code, r.text))
+            failures += 1
+    if failures:
+        sys.stderr.write("Failed to clear action rules for {0} of {1} destinations\n".format(failures, len(destinations)))
+        sys.exit(3)
+    if args.service:
+        print 'Cleared action rules for destination', args.service
+    else:
+        print 'Cleared fault injection rules from all microservices'
 
 def action_list(args):
     r = a8_get('{0}/v1/rules/actions'.format(args.a8_controller_url),
                args.a8_controller_token,
-               showcurl=args.debug)
+               showcurl=args.debug,
+               cache=get_cache(args))
     fail_unless(r, 200)
     service_rules = r.json()["services"]
     #service_rules = { "ratings": test_fault_rules } #FB TEMP
 
-    result_list = []
-    for action_rules in service_rules.itervalues():
-        for rule in sort_rules(action_rules):
-            action_entry = {
-                "id": rule["id"],
-                "destination": rule["destination"],
-                "priority": rule["priority"],
-                "actions": []
-            }
-            if "match" in rule:
-                match = rule["match"]
-                if "source" in match:
-                    action_entry["source"] = versioned_service_name(match["source"]["name"], match["source"].get("tags"))
-                if "headers" in match:
-                    action_entry["headers"] = []
-                    for header, pattern in match["headers"].iteritems():
-                        action_entry["headers"].append(header + ":" + pattern)
-            for action in rule["actions"]:
-                version = tags_to_version(action.get("tags"))
-                if action["action"] == "delay":
-                    action_entry["actions"].append("%s(%s->delay=%s)" % (version, action["probability"], action["duration"]))                     
-                elif action["action"] == "abort":
-                    action_entry["actions"].append("%s(%s->abort=%s)" % (version, action["probability"], action["return_code"]))
-                elif action["action"] == "trace":                     
-                    action_entry["actions"].append("%s(trace)" % (version)) #, action["log_key"], action["log_value"]))
-            result_list.append(action_entry)
-    if args.json:
-        print json.dumps(result_list, indent=2)
-    else:
-        x = PrettyTable(["Destination", "Source", "Headers", "Priority", "Actions", "Rule Id"])
-        x.align = "l"
-        for entry in result_list:
-            x.add_row([entry["destination"],
-                       entry.get("source", ""),
-                       ", ".join(entry.get("headers", [])),
-                       entry["priority"],
-                       ", ".join(entry["actions"]),
-                       entry["id"]
-            ])
-        print x
+    def action_entries():
+        for action_rules in service_rules.itervalues():
+            for rule in sort_rules(action_rules):
+                action_entry = {
+                    "id": rule["id"],
+                    "destination": rule["destination"],
+                    "priority": rule["priority"],
+                    "actions": []
+                }
+                if "match" in rule:
+                    match = rule["match"]
+                    if "source" in match:
+                        action_entry["source"] = versioned_service_name(match["source"]["name"], match["source"].get("tags"))
+                    if "headers" in match:
+                        action_entry["headers"] = []
+                        for header, pattern in match["headers"].iteritems():
+                            action_entry["headers"].append(header + ":" + pattern)
+                for action in rule["actions"]:
+                    version = tags_to_version(action.get("tags"))
+                    if action["action"] == "delay":
+                        action_entry["actions"].append("%s(%s->delay=%s)" % (version, action["probability"], action["duration"]))                     
+                    elif action["action"] == "abort":
+                        action_entry["actions"].append("%s(%s->abort=%s)" % (version, action["probability"], action["return_code"]))
+                    elif action["action"] == "trace":                     
+                        action_entry["actions"].append("%s(trace)" % (version)) #, action["log_key"], action["log_value"]))
+                yield action_entry
+    print_entries(args, action_entries(),
+                  ["Destination", "Source", "Headers", "Priority", "Actions", "Rule Id"],
+                  lambda entry: [entry["destination"],
+                                 entry.get("source", ""),
+                                 ", ".join(entry.get("headers", [])),
+                                 entry["priority"],
+                                 ", ".join(entry["actions"]),
+                                 entry["id"]
+                                 ])
 
 def add_action(args):
     if not args.destination or not (args.source or args.header or args.cookie):
@@ -657,53 +981,11 @@ def add_action(args):
             if rule["priority"] >= priority:
                 priority = rule["priority"] + 10
 
-    if args.header or args.cookie:
-        headers = {}
-        if args.header:
-            for header in args.header:
-                key, sep, value = header.partition(':')
-                headers[key] = value
-        if args.cookie:
-            for cookie in args.cookie:
-                headers['Cookie'] = '.*?'+cookie
-    else:
-        headers = None
-        
-    actions = []
-    for action in args.action:
-        r = ACTION_PARSER.parse(action)
-        if not r:
-            print "Invalid --action value: %s" % action
-            sys.exit(6)
-        version = r['version'].strip()
-        weight = float(r['weight'].strip())
-        action_type = r['action'].strip()
-        value = r['value'].strip()
-        if action_type == 'delay':
-            rule_action = {
-                "action" : "delay",
-                "probability" : weight,
-                "duration": float(value),
-                "tags": version_to_tags(version)
-            }
-            actions.append(rule_action)
-        elif action_type == 'abort':
-            rule_action = {
-                "action" : "abort",
-                "probability" : weight,
-                "return_code": int(value),
-                "tags": version_to_tags(version)
-            }
-            actions.append(rule_action)
-        else:
-            print "Invalid --action type: %s" % action
-            sys.exit(7)
-            
     rule = action_rule(args.source,
                        args.destination,
-                       headers,
+                       match_headers(args.header, args.cookie),
                        priority,
-                       actions)
+                       parse_actions(args.action))
     
     current_rules.append(rule)
     payload = { "rules": current_rules }
@@ -716,6 +998,44 @@ def add_action(args):
     fail_unless(r, 201)
     print 'Set action rule for destination %s' % args.destination
 
+def plan_rules(args):
+    changes, unchanged = plan_changes(args, load_manifest(args.file))
+    for method, path, rules, message in changes:
+        if method == "PUT":
+            print "%s %s (%d rules)" % (method, path, len(rules))
+        else:
+            print method, path
+    print "Plan: %d to set, %d to delete, %d unchanged" % (len([c for c in changes if c[0] == "PUT"]),
+                                                          len([c for c in changes if c[0] == "DELETE"]),
+                                                          unchanged)
+
+def apply_rules(args):
+    changes, unchanged = plan_changes(args, load_manifest(args.file))
+    if not changes:
+        print "No changes to apply"
+        return
+
+    def send(change):
+        method, path, rules, message = change
+        if method == "PUT":
+            return a8_put(args.a8_controller_url + path,
+                          args.a8_controller_token,
+                          json.dumps({ "rules": rules }),
+                          showcurl=args.debug)
+        return a8_delete(args.a8_controller_url + path,
+                         args.a8_controller_token,
+                         showcurl=args.debug)
+
+    failed = False
+    for (method, path, rules, message), r in zip(changes, parallel_map(send, changes, args.concurrency)):
+        if r.status_code in [200, 201]:
+            print message
+        else:
+            sys.stderr.write("Failed to {0} {1}: {2} {3}\n".format(method, path, r.status_code, r.text))
+            failed = True
+    if failed:
+        sys.exit(3)
+
 def delete_rule(args):
     r = a8_delete('{}/v1/rules?id={}'.format(args.a8_controller_url, args.id),
                   args.a8_controller_token,
@@ -724,6 +1044,7 @@ def delete_rule(args):
     print 'Deleted rule with id: %s' % args.id
 
 def _print_assertion_results(results):
+    from prettytable import PrettyTable
     x = PrettyTable(["AssertionName", "Source", "Destination", "Result", "ErrorMsg"])
     x.align = "l"
     newlist={}
@@ -740,6 +1061,7 @@ def _print_assertion_results(results):
     print x
 
 def run_recipe(args):
+    from gremlin import ApplicationGraph, A8FailureGenerator, A8AssertionChecker
     if not args.topology or not args.scenarios:
         print "You must specify --topology and --scenarios"
         sys.exit(4)
@@ -769,6 +1091,7 @@ def run_recipe(args):
     with open(args.topology) as fp:
         app = json.load(fp)
     topology = ApplicationGraph(app)
+    topology.freeze()
     if args.debug:
         print "Using topology:\n", topology
 
@@ -780,7 +1103,8 @@ def run_recipe(args):
             checklist = json.load(fp)
 
     fg = A8FailureGenerator(topology, a8_controller_url='{0}/v1/rules'.format(args.a8_controller_url), a8_controller_token=args.a8_controller_token,
-                            header=header, pattern='.*?'+pattern, debug=args.debug)
+                            header=header, pattern='.*?'+pattern, debug=args.debug,
+                            chunk_size=args.chunk_size, concurrency=args.concurrency)
     fg.setup_failures(scenarios)
 
     start_time = datetime.datetime.utcnow().isoformat()
@@ -811,13 +1135,13 @@ def run_recipe(args):
 
         # TODO: Obtain the logstash index as user input or use logstash-YYYY.MM.DD with current date and time.                                                                                                                              
         ac = A8AssertionChecker(es_host=log_server, trace_log_value=fg.get_id(),
-                index=["_all"], debug=args.debug)      
+                index=["_all"], debug=args.debug, request_id_key=header)      
         results = ac.check_assertions(checklist, continue_on_error=True)
         if args.json:
             print json.dumps(results, indent=2)
         else:
             _print_assertion_results(results)
-        clear_rules(args)
+        fg.clear_rules_from_all_proxies()
 
 def traffic_start(args):
     if args.amount < 0 or args.amount > 100:
@@ -840,11 +1164,11 @@ def traffic_start(args):
 
     default_version = tags_to_version(backends[0]["tags"])
 
-    registry_url, registry_token = args.a8_registry_url, args.a8_registry_token
-    if not is_active(args.service, default_version, registry_url, registry_token, args.debug):
+    registry = RegistrySnapshot(args.a8_registry_url, args.a8_registry_token, args.debug)
+    if not is_active(registry, args.service, default_version):
         print "Invalid state for start operation: service \"%s\" is not currently receiving traffic" % args.service
         sys.exit(6)
-    if not is_active(args.service, args.version, registry_url, registry_token, args.debug):
+    if not is_active(registry, args.service, args.version):
         print "Invalid state for start operation: service \"%s\" does not have active instances of version \"%s\"" % (args.service, args.version)
         sys.exit(7)
 
@@ -25,6 +25,7 @@ import urllib
 import datetime, time
 import pprint
 from parse import compile
+from session import get_session, get_timeout
 
 def passOrfail(result):
     if result:
@@ -33,6 +34,7 @@ def passOrfail(result):
         return "FAIL"
 
 def a8_get(url, token, headers={'Accept': 'application/json'}, showcurl=False, extra_headers={}):
+    headers = dict(headers) # never modify the shared default
     if token != "" :
         headers['Authorization'] = "Bearer " + token
     if extra_headers:
@@ -43,7 +45,7 @@ def a8_get(url, token, headers={'Accept': 'application/json'}, showcurl=False, e
         print "curl", curl_headers, url
 
     try:
-        r = requests.get(url, headers=headers)
+        r = get_session().get(url, headers=headers, timeout=get_timeout())
     except Exception, e:
         sys.stderr.write("Could not contact {0}".format(url))
         sys.stderr.write("\n")
@@ -60,6 +62,7 @@ def a8_post(url, token, body, headers={'Accept': 'application/json', 'Content-ty
     """
     @type body: str
     """
+    headers = dict(headers) # never modify the shared default
     if token != "" :
         headers['Authorization'] = "Bearer " + token
     if extra_headers:
@@ -70,7 +73,7 @@ def a8_post(url, token, body, headers={'Accept': 'application/json', 'Content-ty
         print "REQ:", "curl -i -X POST", url, curl_headers, "--data", '\'{0}\''.format(body.replace('\'', '\\\''))
 
     try:
-        r = requests.post(url, headers=headers, data=body)
+        r = get_session().post(url, headers=headers, data=body, timeout=get_timeout())
     except Exception, e:
         sys.stderr.write("Could not POST to {0}".format(url))
         sys.stderr.write("\n")
@@ -89,6 +92,7 @@ def a8_put(url, token, body, headers={'Accept': 'application/json', 'Content-typ
     @type body: str
     """
 
+    headers = dict(headers) # never modify the shared default
     if token != "" :
         headers['Authorization'] = "Bearer " + token
     if extra_headers:
@@ -99,7 +103,7 @@ def a8_put(url, token, body, headers={'Accept': 'application/json', 'Content-typ
         print "REQ:", "curl -i -X PUT", url, curl_headers, "--data", '\'{0}\''.format(body.replace('\'', '\\\''))
 
     try:
-        r = requests.put(url, headers=headers, data=body)
+        r = get_session().put(url, headers=headers, data=body, timeout=get_timeout())
     except Exception, e:
         sys.stderr.write("Could not PUT to {0}".format(url))
         sys.stderr.write("\n")
@@ -114,6 +118,7 @@ def a8_put(url, token, body, headers={'Accept': 'application/json', 'Content-typ
     return r
 
 def a8_delete(url, token, headers={'Accept': 'application/json'}, showcurl=False, extra_headers={}):
+    headers = dict(headers) # never modify the shared default
     if token != "" :
         headers['Authorization'] = "Bearer " + token
     if extra_headers:
@@ -124,7 +129,7 @@ def a8_delete(url, token, headers={'Accept': 'application/json'}, showcurl=False
         print "curl -X DELETE", curl_headers, url
 
     try:
-        r = requests.delete(url, headers=headers)
+        r = get_session().delete(url, headers=headers, timeout=get_timeout())
     except Exception, e:
         sys.stderr.write("Could not DELETE {0}".format(url))
         sys.stderr.write("\n")
@@ -809,7 +814,8 @@ def run_recipe(args):
         time.sleep(5)
 
         checks = {
-            "checklist": checklist
+            "checklist": checklist,
+            "header": header
         }
     
         # Get the results
@@ -0,0 +1,50 @@
+# Copyright 2016 IBM Corporation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Shared HTTP session used to talk to the Amalgam8 Controller, Registry and Gremlin Service
+
+import requests
+from requests.adapters import HTTPAdapter
+
+POOL_CONNECTIONS = 10 # number of hosts to keep a connection pool for
+POOL_MAXSIZE = 10     # number of keep-alive connections to keep per host
+
+_session = None
+_pool_maxsize = 0
+_timeout = None
+
+def get_session(pool_maxsize=None):
+    """
+    Return the process wide requests.Session, creating it on first use.
+    Connections are kept alive and reused across all calls to the same host.
+    Pass pool_maxsize to make room for that many concurrent requests per host.
+    """
+    global _session, _pool_maxsize
+    if _session is None:
+        _session = requests.Session()
+    pool_maxsize = max(pool_maxsize or POOL_MAXSIZE, POOL_MAXSIZE)
+    if pool_maxsize > _pool_maxsize:
+        adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=pool_maxsize)
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+        _pool_maxsize = pool_maxsize
+    return _session
+
+def set_timeout(timeout):
+    """Set the number of seconds to wait to connect or for a response (None waits forever)"""
+    global _timeout
+    _timeout = timeout
+
+def get_timeout():
+    return _timeout
@@ -26,6 +26,9 @@ a8_log_server = os.getenv('A8_LOG_SERVER', 'localhost:30200')
 app = Flask(__name__, static_url_path='')
 app.debug = True
 
+# Tracking header of each recipe, used to group log entries by request when checking it
+recipe_headers = {}
+
 @app.route('/api/v1/recipes', methods=["POST"])
 def post_recipe():
     payload = request.get_json()
@@ -48,9 +51,11 @@ def post_recipe():
         abort(400, "Header_pattern required")
 
     appgraph = ApplicationGraph(topology)
+    appgraph.freeze()
     fg = A8FailureGenerator(appgraph, a8_controller_url='{0}/v1/rules'.format(a8_controller_url), a8_controller_token=a8_controller_token,
                             header=header, pattern=pattern, debug=debug)
     fg.setup_failures(scenarios)
+    recipe_headers[fg.get_id()] = header
     return make_response(jsonify(recipe_id=fg.get_id()), 201, {'location': url_for('get_recipe_results', recipe_id=fg.get_id())})
 
 @app.route('/api/v1/recipes/<recipe_id>', methods=["POST"])
@@ -64,8 +69,9 @@ def get_recipe_results(recipe_id):
         abort(400, "Checklist required")
     
     log_server = checklist.get('log_server', a8_log_server)
+    header = payload.get("header") or recipe_headers.get(recipe_id, "X-Request-ID")
     
-    ac = A8AssertionChecker(es_host=log_server, trace_log_value=recipe_id, index=["_all"])      
+    ac = A8AssertionChecker(es_host=log_server, trace_log_value=recipe_id, index=["_all"], request_id_key=header)      
     results = ac.check_assertions(checklist, continue_on_error=True)
 
     #print json.dumps(results, indent=2)
@@ -91,6 +97,7 @@ def delete_recipe(recipe_id):
     if r.status_code != 200 and r.status_code != 204:
         abort(r.status_code)
 
+    recipe_headers.pop(recipe_id, None)
     return ""
 
 if __name__ == '__main__':
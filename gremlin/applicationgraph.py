@@ -1,6 +1,5 @@
 # coding=utf-8
-from collections import defaultdict
-import networkx as nx
+from array import array
 
 class ApplicationGraph(object):
     """Represent the topology of an application to be tested by Gremlin"""
@@ -26,7 +25,23 @@ class ApplicationGraph(object):
         assert isinstance(debug, bool)
         assert model is None or isinstance(model, dict)
 
-        self._graph = nx.DiGraph()
+        # Services are interned to small integer ids, which index the per-service lists below.
+        # The adjacency lists are arrays of service ids, and each edge is keyed by a single
+        # integer in _edges, so a topology costs a few bytes per edge instead of a dict per edge.
+        self._ids = {}           # service name -> id
+        self._names = []         # id -> service name
+        self._instances = []     # id -> service proxies
+        self._successors = []    # id -> array of the ids of its dependencies
+        self._predecessors = []  # id -> array of the ids of its dependents
+        self._edges = {}         # edge key -> edge color (None if not colored)
+        # Cached tuples of the names of the dependents and dependencies of a service,
+        # built on first use (or all at once by freeze) and cleared when the graph changes
+        self._dependents = {}
+        self._dependencies = {}
+        # Memoized breadth first searches, also cleared when the graph changes
+        self._upstream = {}       # service -> (transitive dependents, BFS parents)
+        self._downstream = {}     # service -> (transitive dependencies, BFS parents)
+        self._neighbourhoods = {} # (service, hops) -> services within hops calls
         self.debug = debug
 
         if model:
@@ -38,44 +53,210 @@ class ApplicationGraph(object):
                 for destination in destinations:
                     self.add_dependency(source, destination)
 
+    def _intern(self, name):
+        """Return the id of a service, adding the service if it is not known yet"""
+        sid = self._ids.get(name)
+        if sid is None:
+            sid = len(self._names)
+            self._ids[name] = sid
+            self._names.append(name)
+            self._instances.append(None)
+            self._successors.append(array('i'))
+            self._predecessors.append(array('i'))
+        return sid
+
+    def _edge_key(self, fromS, toS):
+        return (self._ids[fromS] << 32) | self._ids[toS]
+
+    def _invalidate(self):
+        self._dependents = {}
+        self._dependencies = {}
+        self._upstream = {}
+        self._downstream = {}
+        self._neighbourhoods = {}
+
+    def _neighbours(self, cache, adjacency, service):
+        names = cache.get(service)
+        if names is None:
+            sid = self._ids.get(service)
+            names = tuple(self._names[i] for i in adjacency[sid]) if sid is not None else ()
+            cache[service] = names
+        return names
+
+    def freeze(self):
+        """Build the dependents and dependencies of every service up front, once the graph is loaded"""
+        for name in self._names:
+            self._neighbours(self._dependents, self._predecessors, name)
+            self._neighbours(self._dependencies, self._successors, name)
+
     def add_service(self, name, service_proxies=None):
-        self._graph.add_node(name)
+        self._invalidate()
+        sid = self._intern(name)
         if service_proxies is None:
             service_proxies = []
-        self._graph.node[name]['instances'] = service_proxies
+        self._instances[sid] = service_proxies
 
     def add_dependency(self, fromS, toS):
-        self._graph.add_path([fromS, toS])
+        self._invalidate()
+        from_id = self._intern(fromS)
+        to_id = self._intern(toS)
+        key = (from_id << 32) | to_id
+        if key not in self._edges:
+            self._edges[key] = None
+            self._successors[from_id].append(to_id)
+            self._predecessors[to_id].append(from_id)
 
     def get_dependents(self, service):
-        dservices = []
-        for e in self._graph.in_edges(service):
-            dservices.append(e[0])
-        return dservices
+        """Return a tuple of the services that call service"""
+        return self._neighbours(self._dependents, self._predecessors, service)
 
     def get_dependencies(self, service):
-        dservices = []
-        for e in self._graph.out_edges(service):
-            dservices.append(e[0])
-        return dservices
+        """Return a tuple of the services that service calls"""
+        return self._neighbours(self._dependencies, self._successors, service)
+
+    def _bfs(self, sid, adjacencies, max_hops=None):
+        """
+        Breadth first search from the service with id sid along one or more adjacency lists.
+        @return: the ids reached, nearest first and excluding sid, and a dict of the parent of each id reached
+        """
+        parents = {sid: None}
+        order = []
+        frontier = [sid]
+        hops = 0
+        while frontier and (max_hops is None or hops < max_hops):
+            hops += 1
+            next_frontier = []
+            for node in frontier:
+                for adjacency in adjacencies:
+                    for neighbour in adjacency[node]:
+                        if neighbour not in parents:
+                            parents[neighbour] = node
+                            next_frontier.append(neighbour)
+            order.extend(next_frontier)
+            frontier = next_frontier
+        return order, parents
+
+    def _search(self, cache, adjacency, service):
+        result = cache.get(service)
+        if result is None:
+            sid = self._ids.get(service)
+            if sid is None:
+                result = ((), {})
+            else:
+                order, parents = self._bfs(sid, (adjacency,))
+                result = (tuple(self._names[i] for i in order), parents)
+            cache[service] = result
+        return result
+
+    def get_upstream(self, service):
+        """Return a tuple of the services that call service, directly or indirectly, nearest first"""
+        return self._search(self._upstream, self._predecessors, service)[0]
+
+    def get_downstream(self, service):
+        """Return a tuple of the services that service calls, directly or indirectly, nearest first"""
+        return self._search(self._downstream, self._successors, service)[0]
+
+    def get_neighbours(self, service, hops=1):
+        """Return a tuple of the services within hops calls of service, in either direction, nearest first"""
+        key = (service, hops)
+        names = self._neighbourhoods.get(key)
+        if names is None:
+            sid = self._ids.get(service)
+            if sid is None:
+                names = ()
+            else:
+                order, parents = self._bfs(sid, (self._successors, self._predecessors), hops)
+                names = tuple(self._names[i] for i in order)
+            self._neighbourhoods[key] = names
+        return names
+
+    def get_shortest_path(self, fromS, toS):
+        """
+        Return the list of services on a shortest chain of calls from fromS to toS, both included,
+        or None if fromS does not call toS, directly or indirectly
+        """
+        if fromS not in self._ids or toS not in self._ids:
+            return None
+        parents = self._search(self._downstream, self._successors, fromS)[1]
+        sid = self._ids[toS]
+        if sid not in parents:
+            return None
+        path = []
+        while sid is not None:
+            path.append(self._names[sid])
+            sid = parents[sid]
+        path.reverse()
+        return path
 
     def get_services(self):
-        return self._graph.nodes()
+        return list(self._names)
+
+    def has_service(self, service):
+        return service in self._ids
+
+    def has_dependency(self, fromS, toS):
+        return fromS in self._ids and toS in self._ids and self._edge_key(fromS, toS) in self._edges
 
     def get_service_instances(self, service):
-        if 'instances' in self._graph.node[service]:
-            return self._graph.node[service]['instances']
+        instances = self._instances[self._ids[service]]
+        if instances is not None:
+            return instances
         else:
             #print("No instances for service {}".format(service))
             return []
 
-    def _get_networkX(self):
-        return self._graph
+    def get_edges(self, color=None):
+        """Return the (source, destination) dependencies, only those of the given color if there is one"""
+        edges = []
+        for from_id, successors in enumerate(self._successors):
+            for to_id in successors:
+                if color is None or self._edges[(from_id << 32) | to_id] == color:
+                    edges.append((self._names[from_id], self._names[to_id]))
+        return edges
+
+    def get_edge_color(self, fromS, toS):
+        return self._edges[self._edge_key(fromS, toS)]
+
+    def set_edge_color(self, fromS, toS, color):
+        key = self._edge_key(fromS, toS)
+        if key not in self._edges:
+            raise KeyError((fromS, toS))
+        self._edges[key] = color
+
+    def set_edge_colors(self, color):
+        """Color all the dependencies"""
+        for key in self._edges:
+            self._edges[key] = color
+
+    @classmethod
+    def from_networkx(cls, graph, debug=False):
+        """Create an ApplicationGraph from a networkx.DiGraph, as built by to_networkx()"""
+        app = cls(debug=debug)
+        for name, data in graph.nodes(data=True):
+            app.add_service(name, data.get('instances'))
+        for fromS, toS, data in graph.edges(data=True):
+            app.add_dependency(fromS, toS)
+            app.set_edge_color(fromS, toS, data.get('color'))
+        return app
+
+    def to_networkx(self):
+        """
+        Return a copy of the graph as a networkx.DiGraph, with the service proxies in the
+        'instances' node attribute and the edge colors in the 'color' edge attribute.
+        Requires networkx, which ApplicationGraph itself does not need.
+        """
+        import networkx as nx
+        graph = nx.DiGraph()
+        for name in self._names:
+            graph.add_node(name, instances=self.get_service_instances(name))
+        for fromS, toS in self.get_edges():
+            graph.add_edge(fromS, toS, color=self.get_edge_color(fromS, toS))
+        return graph
 
     def __str__(self):
         retval = ""
-        for node in self._graph.nodes():
+        for node in self._names:
             retval = retval + "Node: {}\n".format(node)
-        for edge in self._graph.edges():
+        for edge in self.get_edges():
             retval = retval + "Edge: {}->{}\n".format(edge[0], edge[1])
         return retval
@@ -3,17 +3,20 @@
 import json
 
 from elasticsearch import Elasticsearch
+from elasticsearch import helpers
 import datetime
 import pprint
 import warnings
 import isodate
 import sys
 
-import re
-from collections import defaultdict, namedtuple
+from array import array
+from collections import namedtuple, Counter, defaultdict
+from itertools import islice, izip
 import datetime
 import time
 import copy
+from duration import parse_duration
 from __builtin__ import dict
 import logging
 import logging.handlers
@@ -28,74 +31,72 @@ import logging.handlers
 
 GremlinTestResult = namedtuple('GremlinTestResult', ['success','errormsg'])
 AssertionResult = namedtuple('AssertionResult', ['name','info','success','errormsg'])
+# A check ready to run: the (source, dest) edge it looks at, the body of its search (None if it
+# needs every log entry of the edge), and functions evaluating the response to that search or
+# the EdgeLog of the edge
+CheckPlan = namedtuple('CheckPlan', ['edge', 'body', 'evaluate', 'evaluate_log'])
 
 max_query_results = 500
 
-def _duration_to_floatsec(s):
-    r = re.compile(r"(([0-9]*(\.[0-9]*)?)(\D+))", re.UNICODE)
-    start=0
-    m = r.search(s, start)
-    vals = defaultdict(lambda: 0)
-    while m is not None:
-        unit = m.group(4)
-        try:
-            value = float(m.group(2))
-        except ValueError:
-            print(s, unit, m.group(2))
-            return datetime.timedelta()
-        if unit == "h":
-            vals["hours"] = value
-        elif unit == 'm':
-            vals["minutes"] = value
-        elif unit == 's':
-            vals["seconds"] = value
-        elif unit == "ms":
-            vals["milliseconds"] = value
-        elif unit == "us":
-            vals["microseconds"] = value
-        else:
-            raise("Unknown time unit")
-        start = m.end(1)
-        m = r.search(s, start)
-    td = datetime.timedelta(**vals)
-    duration_us = (td.microseconds + (td.seconds + td.days * 24 * 3600) * 10**6)
-    return duration_us/(1.0 * 10**6)
+# Checks evaluated with aggregations fetch at most this many offending entries or values
+max_examples = 3
 
-# def _since(timestamp):
-#     return time.time()-timestamp
+# check_assertions() sends the queries of a checklist in _msearch requests of at most this many searches
+msearch_batch_size = 100
 
-def _check_value_recursively(key, val, haystack):
-    """
-    Check **resursively** if there is a given key with a given value in the
-    given dictionary.
+# Checks that look at every log entry stream them with the scroll API, one page of
+# scroll_size hits (per shard) at a time, instead of fetching max_query_results hits
+scroll_size = 1000
+scroll_timeout = '1m'
 
-    ..warning:
-        This is geared at JSON dictionaries, so some corner cases are ignored,
-        we assume all iterables are either arrays or dicts
+# Default tolerance of bounded_retries on the spacing of retries (errdelta)
+retry_errdelta = '10ms'
 
-    :param key: the key to look for
-    :param val: value to look for
-    :param haystack: the dictionary
+# def _since(timestamp):
+#     return time.time()-timestamp
 
-    """
-    if isinstance(haystack, list):
-        return any([_check_value_recursively(key, val, l) for l in haystack])
-    elif isinstance(haystack, dict):
-        if not key in haystack:
-            return any([_check_value_recursively(key, val, d) for k, d in haystack.items()
-                        if isinstance(d, list) or isinstance(d, dict)])
-        else:
-            return haystack[key] == val
-    else:
-        return False
+def _percentile(values, percent):
+    """Return the percent-th percentile of the sorted list values, interpolating between ranks"""
+    rank = (len(values) - 1) * percent / 100.0
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
 
 
-def _get_by(key, val, l):
+class EdgeLog(object):
     """
-    Out of list *l* return all elements that have *key=val*
-    This comes in handy when you are working with aggregated/bucketed queries
+    The log entries of one (source, dest) edge, by column: entry i has status status[i] (0 if missing),
+    upstream response time latency[i] (NaN if missing), timestamp_in_ms timestamp[i],
+    request tracking header value request_ids[i] (the id of the client request, shared by its
+    retries), uri uris[i], and trace log key value trace_values[i] (the recipe ID, the same for
+    every entry fetched by A8AssertionChecker)
     """
-    return [x for x in l if _check_value_recursively(key, val, x)]
+
+    fields = ['status', 'upstream_response_time', 'timestamp_in_ms', 'uri']
+
+    def __init__(self, trace_log_key, request_id_key, entries):
+        """
+        @param entries: an iterable of log entry _sources, with at least the fields
+        EdgeLog.fields, trace_log_key and request_id_key
+        """
+        self.status = array('i')
+        self.latency = array('d')
+        self.timestamp = array('d')
+        self.request_ids = []
+        self.uris = []
+        self.trace_values = []
+        nan = float('nan')
+        for entry in entries:
+            self.status.append(int(entry.get('status', 0)))
+            latency = entry.get('upstream_response_time')
+            self.latency.append(float(latency) if latency is not None else nan)
+            self.timestamp.append(float(entry.get('timestamp_in_ms', 0)))
+            self.request_ids.append(entry.get(request_id_key))
+            self.uris.append(entry.get('uri'))
+            self.trace_values.append(entry.get(trace_log_key))
+
+    def __len__(self):
+        return len(self.status)
 
 
 class A8AssertionChecker(object):
@@ -107,11 +108,13 @@ class A8AssertionChecker(object):
     def __init__(self, es_host=None,
                  trace_log_value=None,
                  trace_log_key='gremlin_recipe_id',
-                 index="", debug=False):
+                 index="", debug=False,
+                 request_id_key='X-Request-ID'):
         """
         param host: the elasticsearch host
         trace_log_key: the json field name holding the test ID (default is 'gremlin_recipe_id')
         trace_log_value: the recipe ID
+        request_id_key: the json field name holding the request tracking header of the recipe (default is 'X-Request-ID')
         """
         assert es_host is not None and trace_log_value is not None
         self._es = Elasticsearch(hosts=[es_host])
@@ -120,6 +123,7 @@ class A8AssertionChecker(object):
         # self.pattern = pattern
         self.trace_log_key = trace_log_key
         self.trace_log_value = trace_log_value
+        self.request_id_key = request_id_key
         # self.start_time=start_time
         # self.end_time=end_time
         # self.header_field_name = header_field_name
@@ -145,14 +149,20 @@ class A8AssertionChecker(object):
             'bounded_response_time' : self.check_bounded_response_time,
             'http_status' : self.check_http_status,
             'bounded_retries' : self.check_bounded_retries,
-            'at_most_requests': self.check_at_most_requests
+            'at_most_requests': self.check_at_most_requests,
+            'latency_percentile': self.check_latency_percentile,
+            'latency_histogram': self.check_latency_histogram,
+            'error_rate': self.check_error_rate
+        }
+        self.plandict = {
+            'bounded_response_time' : self._plan_bounded_response_time,
+            'http_status' : self._plan_http_status,
+            'bounded_retries' : self._plan_bounded_retries,
+            'at_most_requests': self._plan_at_most_requests,
+            'latency_percentile': self._plan_latency_percentile,
+            'latency_histogram': self._plan_latency_histogram,
+            'error_rate': self._plan_error_rate
         }
-
-    def _check_non_zero_results(self, data):
-        """
-        Checks wheter the output we got from elasticsearch is empty or not
-        """
-        return data["hits"]["total"] != 0 and len(data["hits"]["hits"]) != 0
 
     def _get_query_object(self, src=None, dst=None):
         body={
@@ -173,35 +183,151 @@ class A8AssertionChecker(object):
             body["query"]["bool"]["must"].append({"match": {"dst": dst}})
         return body
 
-    def check_bounded_response_time(self, **kwargs):
+    def _scan(self, query_body, fields=None):
+        """
+        Generate the _source of every log entry matching query_body, holding at most one
+        scroll page in memory. The scroll is cleared if the caller stops early.
+        @param fields: the _source fields to fetch (all of them if None)
+        """
+        body = {"query": query_body["query"]}
+        if fields is not None:
+            body["_source"] = fields
+        for hit in helpers.scan(self._es, query=body, index=self.index,
+                                scroll=scroll_timeout, size=scroll_size):
+            yield hit['_source']
+
+    def _aggregation_query(self, query_body, aggs):
+        """
+        Return a search for the aggregations aggs over the log entries matching query_body.
+        No hits are fetched, only the total number of matching entries and the aggregations.
+        """
+        return {"size": 0, "query": query_body["query"], "aggs": aggs}
+
+    def _search(self, body):
+        data = self._es.search(index=self.index, body=body)
+        if self.debug:
+            pprint.pprint(data)
+        return data
+
+    def _msearch(self, bodies):
+        """Run several searches in a single _msearch request, and return their responses in order"""
+        request = []
+        for body in bodies:
+            request.append({})
+            request.append(body)
+        responses = self._es.msearch(index=self.index, body=request)["responses"]
+        if self.debug:
+            pprint.pprint(responses)
+        return responses
+
+    def _edge_log(self, source, dest):
+        """Fetch every log entry from source to dest into an EdgeLog"""
+        query_body = self._get_query_object(source, dest)
+        fields = EdgeLog.fields + [self.trace_log_key, self.request_id_key]
+        return EdgeLog(self.trace_log_key, self.request_id_key, self._scan(query_body, fields))
+
+    def _evaluate(self, plan, data):
+        """Evaluate the response data to the search of a planned check"""
+        if "error" in data:
+            error = data["error"]
+            if isinstance(error, dict):
+                error = error.get("reason", error)
+            return GremlinTestResult(False, "Query failed: {}".format(error))
+        return plan.evaluate(data)
+
+    def _run(self, plan):
+        """Run a single planned check"""
+        if plan.body is None:
+            return plan.evaluate_log(self._edge_log(*plan.edge))
+        return self._evaluate(plan, self._search(plan.body))
+
+    def _search_together(self, plans):
+        """
+        Run the searches of plans in a single _msearch request, and return their responses in order.
+        Plans with the same query share one search, which carries the aggregations of all of them,
+        so that the log entries of an edge are matched once.
+        """
+        bodies = []
+        shared = {}     # query -> index of its search in bodies
+        placement = []  # (index of the search in bodies, aggregation name prefix) of each plan
+        for i, plan in enumerate(plans):
+            assert plan.body["size"] == 0
+            key = json.dumps(plan.body["query"], sort_keys=True)
+            if key not in shared:
+                shared[key] = len(bodies)
+                bodies.append({"size": 0, "query": plan.body["query"], "aggs": {}})
+            prefix = "{}_".format(i)
+            for name, agg in plan.body["aggs"].iteritems():
+                bodies[shared[key]]["aggs"][prefix + name] = agg
+            placement.append((shared[key], prefix))
+
+        responses = self._msearch(bodies)
+        results = []
+        for index, prefix in placement:
+            data = responses[index]
+            if "error" not in data:
+                aggs = dict((name[len(prefix):], agg) for name, agg in data["aggregations"].iteritems()
+                            if name.startswith(prefix))
+                data = {"hits": data["hits"], "aggregations": aggs}
+            results.append(data)
+        return results
+
+    # Each check is planned by a _plan_* method, which validates the arguments and returns a
+    # CheckPlan. Checks answered by aggregations have a search body, and check_assertions() runs
+    # those of a whole checklist in _msearch batches. Checks that need every log entry of their
+    # edge have no body, and are evaluated against an EdgeLog. All the other checks on the same
+    # edge are then evaluated against that EdgeLog too, instead of querying it again.
+
+    def _plan_bounded_response_time(self, **kwargs):
         assert 'source' in kwargs and 'dest' in kwargs and 'max_latency' in kwargs
         dest = kwargs['dest']
         source = kwargs['source']
-        max_latency = _duration_to_floatsec(kwargs['max_latency'])
+        max_latency = parse_duration(kwargs['max_latency'])
         query_body = self._get_query_object(source, dest)
-        data = self._es.search(index=self.index, body=query_body)
-        if self.debug:
-            pprint.pprint(data)
-
-        result = True
-        errormsg = ""
-        if not self._check_non_zero_results(data):
-            result = False
-            errormsg = "No log entries found"
-            return GremlinTestResult(result, errormsg)
+        # Count the entries over the limit, and fetch the slowest of them
+        body = self._aggregation_query(query_body, {
+            "slow": {
+                "filter": {"range": {"upstream_response_time": {"gt": max_latency}}},
+                "aggs": {
+                    "examples": {
+                        "top_hits": {
+                            "size": max_examples,
+                            "sort": [{"upstream_response_time": {"order": "desc"}}],
+                            "_source": ["upstream_response_time", "uri", self.trace_log_key]
+                        }
+                    }
+                }
+            }
+        })
 
-        for message in data["hits"]["hits"]:
-            if float(message['_source']["upstream_response_time"]) > max_latency:
-                result = False
-                errormsg = "{} did not reply in time for request from {}: found one instance where resp time was {}s - max {}s".format(
-                    dest, source, message['_source']["upstream_response_time"], max_latency)
+        def result(total, slow, slowest):
+            if total == 0:
+                return GremlinTestResult(False, "No log entries found")
+            if slow > 0:
+                errormsg = "{} did not reply in time for request from {}: found {} instances where resp time was over {}s, up to {}s".format(
+                    dest, source, slow, max_latency, slowest)
                 if self.debug:
                     print errormsg
-        return GremlinTestResult(result, errormsg)
+                return GremlinTestResult(False, errormsg)
+            return GremlinTestResult(True, "")
 
+        def evaluate(data):
+            slow = data["aggregations"]["slow"]
+            slowest = None
+            if slow["doc_count"] > 0:
+                slowest = slow["examples"]["hits"]["hits"][0]['_source']["upstream_response_time"]
+            return result(data["hits"]["total"], slow["doc_count"], slowest)
 
-    ##check if the interaction between a given pair of services resulted in the required response status
-    def check_http_status(self, **kwargs):
+        def evaluate_log(log):
+            slow = [latency for latency in log.latency if latency > max_latency]
+            return result(len(log), len(slow), max(slow) if slow else None)
+
+        return CheckPlan((source, dest), body, evaluate, evaluate_log)
+
+    def check_bounded_response_time(self, **kwargs):
+        return self._run(self._plan_bounded_response_time(**kwargs))
+
+    def _plan_http_status(self, **kwargs):
         assert 'source' in kwargs and 'dest' in kwargs and 'status' in kwargs
         source = kwargs['source']
         dest = kwargs['dest']
@@ -209,38 +335,57 @@ class A8AssertionChecker(object):
         if isinstance(status, int):
             status = [status]
         query_body = self._get_query_object(source, dest)
-        data = self._es.search(index=self.index, body=query_body)
-        result = True
-        errormsg = ""
-        if not self._check_non_zero_results(data):
-            result = False
-            errormsg = "No log entries found"
-            return GremlinTestResult(result, errormsg)
+        # Count the entries with any other status, by status
+        body = self._aggregation_query(query_body, {
+            "unexpected": {
+                "filter": {"bool": {"must_not": {"terms": {"status": status}}}},
+                "aggs": {
+                    "bystatus": {"terms": {"field": "status", "size": max_examples}}
+                }
+            }
+        })
 
-        for message in data["hits"]["hits"]:
-            hstatus = int(message['_source']['status'])
-            if hstatus not in status:
-                if hstatus == 499: #nginx 499 indicates unexpected timeout
+        def result(total, num_unexpected, hstatuses):
+            """
+            num_unexpected: the number of entries without an expected status, including those with no status
+            hstatuses: the most frequent unexpected statuses, most frequent first
+            """
+            if total == 0:
+                return GremlinTestResult(False, "No log entries found")
+            if num_unexpected > 0:
+                if 499 in hstatuses: #nginx 499 indicates unexpected timeout
                     errormsg = "unexpected connection termination"
+                elif hstatuses:
+                    errormsg = "unexpected status {}".format(hstatuses[0])
                 else:
-                    errormsg = "unexpected status {}".format(message["_source"]["status"])
+                    errormsg = "found {} log entries without a status".format(num_unexpected)
                 if self.debug:
                     print(errormsg)
-                result = False
-        return GremlinTestResult(result, errormsg)
+                return GremlinTestResult(False, errormsg)
+            return GremlinTestResult(True, "")
 
-    def check_at_most_requests(self, source, dest, num_requests, **kwargs):
-        """
-        Check that source service sent at most num_request to the dest service
-        :param source the source service name
-        :param dest the destination service name
-        :param num_requests the maximum number of requests that we expect
-        :return:
-        """
+        def evaluate(data):
+            unexpected = data["aggregations"]["unexpected"]
+            return result(data["hits"]["total"], unexpected["doc_count"],
+                          [int(bucket["key"]) for bucket in unexpected["bystatus"]["buckets"]])
 
-        # Fetch requests for src->dst
-        data = self._es.search(index=self.index, body={
-            "size": max_query_results,
+        def evaluate_log(log):
+            allowed = set(status)
+            unexpected = Counter(hstatus for hstatus in log.status if hstatus not in allowed)
+            num_unexpected = sum(unexpected.itervalues())
+            unexpected.pop(0, None) # EdgeLog status of the entries with no status
+            return result(len(log), num_unexpected, [hstatus for hstatus, count in unexpected.most_common(max_examples)])
+
+        return CheckPlan((source, dest), body, evaluate, evaluate_log)
+
+    ##check if the interaction between a given pair of services resulted in the required response status
+    def check_http_status(self, **kwargs):
+        return self._run(self._plan_http_status(**kwargs))
+
+    def _plan_at_most_requests(self, source, dest, num_requests, **kwargs):
+        # Count requests for src->dst by id. Only the largest bucket is needed.
+        body = {
+            "size": 0,
             "query": {
                 "filtered": {
                     "query": {
@@ -258,116 +403,283 @@ class A8AssertionChecker(object):
                 }
             },
             "aggs": {
-                # Need size, otherwise only top buckets are returned
-                "size": max_query_results,
                 "byid": {
                     "terms": {
                         "field": self.trace_log_key,
+                        "size": 1
                     }
                 }
             }
-        })
+        }
 
-        if self.debug:
-            pprint.pprint(data)
+        def result(total, buckets):
+            """buckets: (id, number of requests) pairs"""
+            if total == 0:
+                return GremlinTestResult(False, "No log entries found")
+            # Check number of requests in each bucket
+            for key, doc_count in buckets:
+                if doc_count > (num_requests + 1):
+                    errormsg = "{} -> {} - expected {} requests, but found {} "\
+                             "requests for id {}".format(
+                                source, dest, num_requests, doc_count - 1, key)
+                    if self.debug:
+                        print errormsg
+                    return GremlinTestResult(False, errormsg)
+            return GremlinTestResult(True, "")
 
-        result = True
-        errormsg = ""
-        if not self._check_non_zero_results(data):
-            result = False
-            errormsg = "No log entries found"
-            return GremlinTestResult(result, errormsg)
+        def evaluate(data):
+            return result(data["hits"]["total"],
+                          [(bucket["key"], bucket["doc_count"]) for bucket in data["aggregations"]["byid"]["buckets"]])
 
-        # Check number of requests in each bucket
-        for bucket in data["aggregations"]["byid"]["buckets"]:
-            if bucket["doc_count"] > (num_requests + 1):
-                errormsg = "{} -> {} - expected {} requests, but found {} "\
-                         "requests for id {}".format(
-                            source, dest, num_requests, bucket['doc_count'] - 1,
-                            bucket['key'])
-                result = False
-                if self.debug:
-                    print errormsg
-                return GremlinTestResult(result, errormsg)
-        return GremlinTestResult(result, errormsg)
+        def evaluate_log(log):
+            return result(len(log), Counter(log.trace_values).most_common(1))
 
-    def check_bounded_retries(self, **kwargs):
+        return CheckPlan((source, dest), body, evaluate, evaluate_log)
+
+    def check_at_most_requests(self, source, dest, num_requests, **kwargs):
+        """
+        Check that source service sent at most num_request to the dest service
+        :param source the source service name
+        :param dest the destination service name
+        :param num_requests the maximum number of requests that we expect
+        :return:
+        """
+        return self._run(self._plan_at_most_requests(source, dest, num_requests, **kwargs))
+
+    def _plan_bounded_retries(self, **kwargs):
         assert 'source' in kwargs and 'dest' in kwargs and 'retries' in kwargs
         source = kwargs['source']
         dest = kwargs['dest']
         retries = kwargs['retries']
         wait_time = kwargs.pop('wait_time', None)
-        errdelta = kwargs.pop('errdelta', 0.0) #datetime.timedelta(milliseconds=10))
+        errdelta = kwargs.pop('errdelta', retry_errdelta)
         by_uri = kwargs.pop('by_uri', False)
+        if wait_time is not None:
+            wait_time = parse_duration(wait_time)
+        if isinstance(errdelta, basestring):
+            errdelta = parse_duration(errdelta)
+        elif isinstance(errdelta, (int, long, float)) and errdelta >= 0:
+            errdelta = float(errdelta)
+        else:
+            raise ValueError("Invalid errdelta: {!r}".format(errdelta))
 
         if self.debug:
             print 'in bounded retries (%s, %s, %s)' % (source, dest, retries)
 
-        data = self._es.search(index=self.index, body={
-            "size": max_query_results,
-            "query": {
-                "filtered": {
-                    "query": {
-                        "match_all": {}
-                    },
-                    "filter": {
-                        "bool": {
-                            "must": [
-                                {"match": {"src": source}},
-                                {"match": {"dst": dest}},
-                                {"match": {self.trace_log_key: self.trace_log_value}}
-                            ]
-                        }
-                    }
-                }
-            },
-            "aggs": {
-                "byid": {
-                    "terms": {
-                        "field": self.trace_log_key if not by_uri else "uri",
-                    }
-                }
-            }
-        })
-
-        if self.debug:
-            pprint.pprint(data)
+        def evaluate_log(log):
+            result = True
+            errormsg = ""
+            if len(log) == 0:
+                result = False
+                errormsg = "No log entries found"
+                return GremlinTestResult(result, errormsg)
 
-        result = True
-        errormsg = ""
-        if not self._check_non_zero_results(data):
-            result = False
-            errormsg = "No log entries found"
-            return GremlinTestResult(result, errormsg)
+            # Group the timestamps by request id (or uri) in a single pass over the entries,
+            # taken in timestamp order so that every group comes out sorted.
+            # Entries without a request id (or uri) cannot be attributed to a request.
+            keys = log.uris if by_uri else log.request_ids
+            timestamps = log.timestamp
+            requests = defaultdict(list)
+            for i in sorted(xrange(len(log)), key=timestamps.__getitem__):
+                if keys[i] is not None:
+                    requests[keys[i]].append(timestamps[i])
+            if not requests:
+                result = False
+                errormsg = "No log entries with a {} found".format("uri" if by_uri else self.request_id_key)
+                return GremlinTestResult(result, errormsg)
 
-        # Check number of req first
-        for bucket in data["aggregations"]["byid"]["buckets"]:
-            if bucket["doc_count"] > (num + 1):
+            # Check number of req first
+            req_id, req_seq = max(requests.iteritems(), key=lambda request: len(request[1]))
+            if len(req_seq) > (retries + 1):
                 errormsg = "{} -> {} - expected {} retries, but found {} retries for request {}".format(
-                    source, dest, retries, bucket['doc_count']-1, bucket['key'])
+                    source, dest, retries, len(req_seq)-1, req_id)
                 result = False
                 if self.debug:
                     print errormsg
                 return GremlinTestResult(result, errormsg)
-        if wait_time is None:
+            if wait_time is None:
+                return GremlinTestResult(result, errormsg)
+
+            # Now we have to check the timestamps
+            min_wait = wait_time - errdelta
+            max_wait = wait_time + errdelta
+            for req_id, req_seq in requests.iteritems():
+                for attempt, (sent, retried) in enumerate(izip(req_seq, islice(req_seq, 1, None)), 1):
+                    observed = (retried - sent)/1000.0
+                    if not (min_wait <= observed <= max_wait):
+                        errormsg = "{} -> {} - expected {}+/-{}s spacing for retry attempt {}, but request {} had a spacing of {}s".format(
+                            source, dest, wait_time, errdelta, attempt, req_id, observed)
+                        result = False
+                        if self.debug:
+                            print errormsg
+                        return GremlinTestResult(result, errormsg)
             return GremlinTestResult(result, errormsg)
 
-        wait_time = _duration_to_floatsec(wait_time)
-        # Now we have to check the timestamps
-        for bucket in data["aggregations"]["byid"]["buckets"]:
-            req_id = bucket["key"]
-            req_seq = _get_by(self.trace_log_key, req_id, data["hits"]["hits"])
-            req_seq.sort(key=lambda x: int(x['_source']["timestamp_in_ms"]))
-            for i in range(len(req_seq) - 1):
-                observed = (req_seq[i + 1]['_source']["timestamp_in_ms"] - req_seq[i]['_source']["timestamp_in_ms"])/1000.0
-                if not (((wait_time - errdelta) <= observed) or (observed <= (wait_time + errdelta))):
-                    errormsg = "{} -> {} - expected {}+/-{}s spacing for retry attempt {}, but request {} had a spacing of {}s".format(
-                        source, dest, wait_time, errdelta, i+1, req_id, observed)
-                    result = False
+        # The spacing of retries needs the timestamp of every request, so this check reads the EdgeLog
+        return CheckPlan((source, dest), None, None, evaluate_log)
+
+    def check_bounded_retries(self, **kwargs):
+        """
+        Check that source retried each request to dest at most retries times
+        :param source the source service name
+        :param dest the destination service name
+        :param retries the maximum number of retries per request
+        :param wait_time the expected spacing between attempts, as a duration string (optional)
+        :param errdelta the tolerance on wait_time, as a duration string or a number of seconds.
+               Each spacing must lie within wait_time +/- errdelta. Defaults to 10ms, since log
+               timestamps have millisecond resolution and retries are scheduled with some jitter.
+        :param by_uri group the requests by uri instead of by request id
+        :return:
+        """
+        return self._run(self._plan_bounded_retries(**kwargs))
+
+    def _plan_latency_percentile(self, **kwargs):
+        """
+        Check percentiles of the response time, e.g., with percentiles={"50": "100ms", "99": "1s"}
+        the median response time must be at most 100ms, and 99% of the requests must take at most 1s
+        """
+        assert 'source' in kwargs and 'dest' in kwargs and 'percentiles' in kwargs
+        source = kwargs['source']
+        dest = kwargs['dest']
+        bounds = sorted((float(percent), parse_duration(max_latency))
+                        for percent, max_latency in kwargs['percentiles'].iteritems())
+        assert bounds and all(0 <= percent <= 100 for percent, max_latency in bounds)
+        query_body = self._get_query_object(source, dest)
+        body = self._aggregation_query(query_body, {
+            "latencies": {"value_count": {"field": "upstream_response_time"}},
+            "percentiles": {
+                "percentiles": {
+                    "field": "upstream_response_time",
+                    "percents": [percent for percent, max_latency in bounds]
+                }
+            }
+        })
+
+        def result(count, values):
+            """values: the response time at each percent of bounds"""
+            if count == 0:
+                return GremlinTestResult(False, "No log entries found")
+            for (percent, max_latency), value in zip(bounds, values):
+                if value > max_latency:
+                    errormsg = "{} did not reply in time for request from {}: p{:g} resp time was {}s - max {}s".format(
+                        dest, source, percent, value, max_latency)
                     if self.debug:
                         print errormsg
-                    break
-        return GremlinTestResult(result, errormsg)
+                    return GremlinTestResult(False, errormsg)
+            return GremlinTestResult(True, "")
+
+        def evaluate(data):
+            values = dict((float(percent), value) for percent, value in
+                          data["aggregations"]["percentiles"]["values"].iteritems())
+            return result(data["aggregations"]["latencies"]["value"],
+                          [values[percent] for percent, max_latency in bounds])
+
+        def evaluate_log(log):
+            latencies = sorted(latency for latency in log.latency if latency == latency) # skip NaNs
+            if not latencies:
+                return result(0, [])
+            return result(len(latencies), [_percentile(latencies, percent) for percent, max_latency in bounds])
+
+        return CheckPlan((source, dest), body, evaluate, evaluate_log)
+
+    def check_latency_percentile(self, **kwargs):
+        return self._run(self._plan_latency_percentile(**kwargs))
+
+    def _plan_latency_histogram(self, **kwargs):
+        """
+        Check the distribution of the response time, e.g., with buckets={"100ms": 0.9, "1s": 0.99}
+        at least 90% of the requests must take less than 100ms, and at least 99% less than 1s
+        """
+        assert 'source' in kwargs and 'dest' in kwargs and 'buckets' in kwargs
+        source = kwargs['source']
+        dest = kwargs['dest']
+        bounds = sorted((parse_duration(max_latency), float(fraction))
+                        for max_latency, fraction in kwargs['buckets'].iteritems())
+        assert bounds and all(0 <= fraction <= 1 for max_latency, fraction in bounds)
+        query_body = self._get_query_object(source, dest)
+        body = self._aggregation_query(query_body, {
+            "latencies": {"value_count": {"field": "upstream_response_time"}},
+            "histogram": {
+                "range": {
+                    "field": "upstream_response_time",
+                    "ranges": [{"to": max_latency} for max_latency, fraction in bounds]
+                }
+            }
+        })
+
+        def result(count, faster):
+            """faster: the number of requests under each bound of bounds"""
+            if count == 0:
+                return GremlinTestResult(False, "No log entries found")
+            for (max_latency, fraction), num_faster in zip(bounds, faster):
+                if num_faster < fraction * count:
+                    errormsg = "{} -> {} - expected {:.2%} of requests to take less than {}s, but found {:.2%}".format(
+                        source, dest, fraction, max_latency, float(num_faster) / count)
+                    if self.debug:
+                        print errormsg
+                    return GremlinTestResult(False, errormsg)
+            return GremlinTestResult(True, "")
+
+        def evaluate(data):
+            return result(data["aggregations"]["latencies"]["value"],
+                          [bucket["doc_count"] for bucket in data["aggregations"]["histogram"]["buckets"]])
+
+        def evaluate_log(log):
+            latencies = [latency for latency in log.latency if latency == latency] # skip NaNs
+            return result(len(latencies), [sum(1 for latency in latencies if latency < max_latency)
+                                           for max_latency, fraction in bounds])
+
+        return CheckPlan((source, dest), body, evaluate, evaluate_log)
+
+    def check_latency_histogram(self, **kwargs):
+        return self._run(self._plan_latency_histogram(**kwargs))
+
+    def _plan_error_rate(self, **kwargs):
+        """
+        Check that at most a fraction max_rate of the requests failed, i.e., got a status
+        of min_status (default 500) or more
+        """
+        assert 'source' in kwargs and 'dest' in kwargs and 'max_rate' in kwargs
+        source = kwargs['source']
+        dest = kwargs['dest']
+        max_rate = float(kwargs['max_rate'])
+        min_status = int(kwargs.get('min_status', 500))
+        query_body = self._get_query_object(source, dest)
+        body = self._aggregation_query(query_body, {
+            "errors": {"filter": {"range": {"status": {"gte": min_status}}}}
+        })
+
+        def result(total, errors):
+            if total == 0:
+                return GremlinTestResult(False, "No log entries found")
+            if errors > max_rate * total:
+                errormsg = "{} -> {} - expected an error rate of at most {:.2%}, but {} of {} requests failed ({:.2%})".format(
+                    source, dest, max_rate, errors, total, float(errors) / total)
+                if self.debug:
+                    print errormsg
+                return GremlinTestResult(False, errormsg)
+            return GremlinTestResult(True, "")
+
+        def evaluate(data):
+            return result(data["hits"]["total"], data["aggregations"]["errors"]["doc_count"])
+
+        def evaluate_log(log):
+            return result(len(log), sum(1 for hstatus in log.status if hstatus >= min_status))
+
+        return CheckPlan((source, dest), body, evaluate, evaluate_log)
+
+    def check_error_rate(self, **kwargs):
+        return self._run(self._plan_error_rate(**kwargs))
+
+    def _plan_assertion(self, name=None, **kwargs):
+        assert name is not None and name in self.plandict
+        return self.plandict[name](**kwargs)
+
+    def _assertion_result(self, name, kwargs, gremlin_test_result):
+        if self.debug and not gremlin_test_result.success:
+            print gremlin_test_result.errormsg
+
+        return AssertionResult(name, str(kwargs), gremlin_test_result.success, gremlin_test_result.errormsg)
 
     def check_assertion(self, name=None, **kwargs):
         # assertion is something like {"name": "bounded_response_time",
@@ -376,28 +688,48 @@ class A8AssertionChecker(object):
 
         assert name is not None and name in self.functiondict
         gremlin_test_result = self.functiondict[name](**kwargs)
-        if self.debug and not gremlin_test_result.success:
-            print gremlin_test_result.errormsg
-
-        return AssertionResult(name, str(kwargs), gremlin_test_result.success, gremlin_test_result.errormsg)
+        return self._assertion_result(name, kwargs, gremlin_test_result)
 
     def check_assertions(self, checklist, continue_on_error=False):
         """Check a set of assertions
+        The checks are planned first. The log entries of each edge with a check that needs them
+        are fetched once, into an EdgeLog that all the checks on the edge are evaluated against.
+        The searches of the other checks are sent msearch_batch_size at a time with _msearch,
+        the checks on the same edge sharing one search. Without continue_on_error, nothing
+        is fetched after the batch holding the first failure.
         @param all boolean if False, stop at first failure
         @return: False if any assertion fails.
         """
 
         assert isinstance(checklist, dict) and 'checks' in checklist
 
+        assertions = checklist['checks']
+        plans = [self._plan_assertion(**assertion) for assertion in assertions]
+        logged = set(plan.edge for plan in plans if plan.body is None)
+        logs = {}
+
         retval = None
         retlist = []
-        for assertion in checklist['checks']:
-            retval = self.check_assertion(**assertion)
-            check = copy.deepcopy(assertion)
-            check['result']=retval.success
-            check['errormsg']=retval.errormsg
-            retlist.append(check)
-            if not retval.success and not continue_on_error:
-                return retlist
+        for start in range(0, len(plans), msearch_batch_size):
+            batch = plans[start:start + msearch_batch_size]
+            for plan in batch:
+                if plan.edge in logged and plan.edge not in logs:
+                    logs[plan.edge] = self._edge_log(*plan.edge)
+            searched = [plan for plan in batch if plan.edge not in logged]
+            responses = iter(self._search_together(searched) if searched else [])
+            for assertion, plan in zip(assertions[start:start + msearch_batch_size], batch):
+                if plan.edge in logged:
+                    gremlin_test_result = plan.evaluate_log(logs[plan.edge])
+                else:
+                    gremlin_test_result = self._evaluate(plan, next(responses))
+                kwargs = dict(assertion)
+                name = kwargs.pop('name')
+                retval = self._assertion_result(name, kwargs, gremlin_test_result)
+                check = copy.deepcopy(assertion)
+                check['result']=retval.success
+                check['errormsg']=retval.errormsg
+                retlist.append(check)
+                if not retval.success and not continue_on_error:
+                    return retlist
 
         return retlist
@@ -0,0 +1,40 @@
+# coding=utf-8
+
+# Parsing of Gremlin recipe durations such as "100ms", "1.5s" or "1h30m"
+
+import re
+
+# Microseconds per unit. In the grammar, "ms" must be tried before "m".
+_UNITS = {"h": 3600 * 10**6, "m": 60 * 10**6, "s": 10**6, "ms": 1000, "us": 1}
+_TERM = r"(\d+(?:\.\d*)?|\.\d+)(h|ms|m|s|us)"
+_DURATION_RE = re.compile(r"(?:%s)+\Z" % _TERM)
+_TERM_RE = re.compile(_TERM)
+
+# Recipes repeat the same few durations many times, so parsed values are memoized.
+# The memo is emptied whenever it fills up, which bounds its size.
+_MEMO_SIZE = 1024
+_memo = {}
+
+def parse_duration(s):
+    """
+    Return the number of seconds in a duration string made of one or more
+    <number><unit> terms, with units h, m, s, ms or us, e.g., "1s500ms".
+    If a unit appears more than once, its last value is used.
+    @raise ValueError: if s is not a valid duration
+    """
+    if not isinstance(s, basestring):
+        raise ValueError("Invalid duration: {!r}".format(s))
+    seconds = _memo.get(s)
+    if seconds is not None:
+        return seconds
+    if not _DURATION_RE.match(s):
+        raise ValueError("Invalid duration: {!r}".format(s))
+    values = {}
+    for value, unit in _TERM_RE.findall(s):
+        values[unit] = float(value)
+    microseconds = int(round(sum(value * _UNITS[unit] for unit, value in values.iteritems())))
+    seconds = microseconds / (1.0 * 10**6)
+    if len(_memo) >= _MEMO_SIZE:
+        _memo.clear()
+    _memo[s] = seconds
+    return seconds
@@ -1,17 +1,20 @@
 # coding=utf-8
 
 import requests
+from requests.adapters import HTTPAdapter
+from multiprocessing.pool import ThreadPool
 import json
-from collections import defaultdict
 import uuid
 import logging
 import httplib
-import re
-import datetime, time
 import sys
+from duration import parse_duration
 logging.basicConfig()
 requests_log = logging.getLogger("requests.packages.urllib3")
 
+DEFAULT_CHUNK_SIZE = 500 # rules per POST to the controller
+DEFAULT_CONCURRENCY = 4  # chunks posted at the same time
+
 def split_service(input):
     colon = input.rfind(':')
     if colon != -1:
@@ -22,42 +25,54 @@ def split_service(input):
         version = None
     return service, version
 
-def _duration_to_floatsec(s):
-    r = re.compile(r"(([0-9]*(\.[0-9]*)?)(\D+))", re.UNICODE)
-    start=0
-    m = r.search(s, start)
-    vals = defaultdict(lambda: 0)
-    while m is not None:
-        unit = m.group(4)
-        try:
-            value = float(m.group(2))
-        except ValueError:
-            print(s, unit, m.group(2))
-            return datetime.timedelta()
-        if unit == "h":
-            vals["hours"] = value
-        elif unit == 'm':
-            vals["minutes"] = value
-        elif unit == 's':
-            vals["seconds"] = value
-        elif unit == "ms":
-            vals["milliseconds"] = value
-        elif unit == "us":
-            vals["microseconds"] = value
+def _hashable(value):
+    """Return a hashable equivalent of a JSON value, equal for equal values"""
+    if isinstance(value, dict):
+        return tuple(sorted((key, _hashable(item)) for key, item in value.iteritems()))
+    if isinstance(value, list):
+        return tuple(_hashable(item) for item in value)
+    return value
+
+def _merge_rules(rules):
+    """
+    Return the rules with all the rules that have the same destination, priority and match
+    merged into the first of them, keeping one copy of each distinct action. Trace actions
+    limited to some versions are dropped from rules that also trace all versions.
+    """
+    merged = []
+    by_key = {}
+    for rule in rules:
+        key = (rule["destination"], rule["priority"], _hashable(rule["match"]))
+        if key in by_key:
+            by_key[key]["actions"].extend(rule["actions"])
         else:
-            raise("Unknown time unit")
-        start = m.end(1)
-        m = r.search(s, start)
-    td = datetime.timedelta(**vals)
-    duration_us = (td.microseconds + (td.seconds + td.days * 24 * 3600) * 10**6)
-    return duration_us/(1.0 * 10**6)
+            rule = dict(rule, actions=list(rule["actions"]))
+            by_key[key] = rule
+            merged.append(rule)
+
+    for rule in merged:
+        trace_all = any(action["action"] == "trace" and not action.get("tags") for action in rule["actions"])
+        actions = []
+        seen = set()
+        for action in rule["actions"]:
+            if trace_all and action["action"] == "trace" and action.get("tags"):
+                continue
+            action_key = _hashable(action)
+            if action_key not in seen:
+                seen.add(action_key)
+                actions.append(action)
+        rule["actions"] = actions
+    return merged
 
 class A8FailureGenerator(object):
 
-    def __init__(self, app, header=None, pattern=None, a8_controller_url = None, a8_controller_token=None, debug=False):
+    def __init__(self, app, header=None, pattern=None, a8_controller_url = None, a8_controller_token=None, debug=False,
+                 chunk_size=DEFAULT_CHUNK_SIZE, concurrency=DEFAULT_CONCURRENCY):
         """
         Create a new failure generator
         @param app ApplicationGraph: instance of ApplicationGraph object
+        @param chunk_size: maximum number of rules to send to the controller in one request
+        @param concurrency: maximum number of requests to send to the controller at the same time
         """
         self.app = app
         self.debug = debug
@@ -69,6 +84,14 @@ class A8FailureGenerator(object):
         self.a8_controller_url = a8_controller_url
         self.a8_controller_token = a8_controller_token
         assert a8_controller_url is not None and a8_controller_token is not None
+        assert chunk_size > 0 and concurrency > 0
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        # Pooled keep-alive connections to the controller, one per concurrent request
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=concurrency)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
         # The failure generator SDK supports only one failure recipe at a given time. A recipe can consist of multiple tests.
         # The trackingheader and pattern fields in the recipes will be ignored. But multiple failure generators
         # can be run from different processes. So, the user has to supply the header name and pattern being used.
@@ -120,12 +143,11 @@ class A8FailureGenerator(object):
         replacestring: <string> string to replace with for Mangle fault -- unused
         """
         rule = args.copy()
-        services = self.app.get_services()
 
         #check defaults
         assert self.header != "" and self.pattern != ""
         assert rule["source"] != "" and rule["dest"] != ""
-        assert rule["source"] in services and rule["dest"] in services
+        assert self.app.has_service(rule["source"]) and self.app.has_service(rule["dest"])
         assert "delayprobability" in rule or "abortprobability" in rule
         if "delayprobability" in rule:
             assert rule['delayprobability'] > 0.0
@@ -134,9 +156,10 @@ class A8FailureGenerator(object):
             assert rule['abortprobability'] > 0.0
             assert rule.get("errorcode", 0) != 0
 
-        graph = self.app._get_networkX()
         ##For graph edges covered by rules, color them red
-        graph[rule['source']][rule['dest']]['color']='red'
+        ##(a partition also covers the reverse of an edge, which is not in the graph)
+        if self.app.has_dependency(rule['source'], rule['dest']):
+            self.app.set_edge_color(rule['source'], rule['dest'], 'red')
 
         source_name, source_version = split_service(rule["source"])
         destination_name, destination_version = split_service(rule["dest"])
@@ -171,7 +194,7 @@ class A8FailureGenerator(object):
             action = {
                 "action": "delay",
                 "probability": rule["delayprobability"],
-                "duration": _duration_to_floatsec(rule["delaytime"])
+                "duration": parse_duration(rule["delaytime"])
             }
             if destination_version:
                 action["tags"] = destination_version.split(",")
@@ -192,6 +215,8 @@ class A8FailureGenerator(object):
     def clear_rules_from_all_proxies(self):
         """
             Clear fault injection rules from all known service proxies.
+            All the rules of this failure generator carry its id as a tag,
+            so they are deleted with a single request.
         """
         if self.debug:
             print 'Clearing rules'
@@ -199,10 +224,10 @@ class A8FailureGenerator(object):
             headers = {"Content-Type" : "application/json"}
             if self.a8_controller_token != "" :
                 headers['Authorization'] = "Bearer " + self.a8_controller_token
-            for rule_id in self._rule_ids:
-                resp = requests.delete(self.a8_controller_url + "?id=" + rule_id,
-                                       headers = headers)
-                resp.raise_for_status()
+            resp = self._session.delete(self.a8_controller_url + "?tag=" + self._id,
+                                        headers = headers)
+            resp.raise_for_status()
+            self._rule_ids = []
         except requests.exceptions.ConnectionError, e:
             print "FAILURE: Could not communicate with control plane %s" % self.a8_controller_url
             print e
@@ -210,56 +235,91 @@ class A8FailureGenerator(object):
 
     #TODO: Create a plugin model here, to support gremlinproxy and nginx
     def push_rules(self):
-        try:
-            headers = {"Content-Type" : "application/json"}
-            if self.a8_controller_token != "" :
-                headers['Authorization'] = "Bearer " + self.a8_controller_token
-            payload = {"rules": self._queue}
-            #print json.dumps(payload, indent=2)
-            resp = requests.post(self.a8_controller_url,
-                                 headers = headers,
-                                 data=json.dumps(payload))
-            resp.raise_for_status()
-            self._rule_ids = resp.json()["ids"]
-        except requests.exceptions.ConnectionError, e:
-            print "FAILURE: Could not communicate with control plane %s" % self.a8_controller_url
-            print e
-            sys.exit(3)
+        """
+            Merge the queued rules that match the same requests (see _merge_rules), then
+            send them to the controller in chunks of at most chunk_size rules,
+            posting up to concurrency chunks at a time. If any chunk fails, the rules
+            of the chunks that succeeded are deleted again.
+        """
+        queued = len(self._queue)
+        self._queue = _merge_rules(self._queue)
+        if self.debug:
+            print 'Merged %d queued rules into %d' % (queued, len(self._queue))
+
+        headers = {"Content-Type" : "application/json"}
+        if self.a8_controller_token != "" :
+            headers['Authorization'] = "Bearer " + self.a8_controller_token
+        chunks = [self._queue[i:i+self.chunk_size] for i in xrange(0, len(self._queue), self.chunk_size)]
+
+        def post_chunk(chunk):
+            try:
+                payload = {"rules": chunk}
+                #print json.dumps(payload, indent=2)
+                return self._session.post(self.a8_controller_url,
+                                          headers = headers,
+                                          data=json.dumps(payload))
+            except requests.exceptions.RequestException, e:
+                return e
+
+        if len(chunks) > 1 and self.concurrency > 1:
+            pool = ThreadPool(min(self.concurrency, len(chunks)))
+            try:
+                responses = pool.map(post_chunk, chunks)
+            finally:
+                pool.terminate()
+        else:
+            responses = [post_chunk(chunk) for chunk in chunks]
+
+        failures = [resp for resp in responses if isinstance(resp, Exception) or not resp.ok]
+        if failures:
+            if self.debug:
+                print '%d of %d rule chunks failed, rolling back' % (len(failures), len(chunks))
+            self.clear_rules_from_all_proxies()
+            if isinstance(failures[0], requests.exceptions.ConnectionError):
+                print "FAILURE: Could not communicate with control plane %s" % self.a8_controller_url
+                print failures[0]
+                sys.exit(3)
+            if isinstance(failures[0], Exception):
+                raise failures[0]
+            failures[0].raise_for_status()
+
+        # Chunks are posted concurrently, but their ids are kept in the order of the queue
+        self._rule_ids = []
+        for resp in responses:
+            self._rule_ids.extend(resp.json()["ids"])
 
     # Generate empty rules to just log requests with Gremlin header
     def _generate_log_rules(self):
-        graph = self.app._get_networkX()
-        for e in graph.edges(data='color'):
-            if e[2] == 'black': #uncovered edge
-                source_name, source_version = split_service(e[0])
-                destination_name, destination_version = split_service(e[1])
-                log_rule = {
-                    "destination": destination_name,
-                    "tags": [ self._id ],
-                    "priority": 10,
-                    "match": {
-                        "source": {
-                            "name": source_name
-                        },
-                        "headers": {
-                            self.header: self.pattern
-                        }
+        for e in self.app.get_edges('black'): #uncovered edges
+            source_name, source_version = split_service(e[0])
+            destination_name, destination_version = split_service(e[1])
+            log_rule = {
+                "destination": destination_name,
+                "tags": [ self._id ],
+                "priority": 10,
+                "match": {
+                    "source": {
+                        "name": source_name
                     },
-                    "actions": [
-                        {
-                            "action": "trace",
-                            "log_key": "gremlin_recipe_id",
-                            "log_value": self._id
-                        }
-                    ]
-                }
-                if source_version:
-                    log_rule["match"]["source"]["tags"] = source_version.split(",")
-                if destination_version:
-                    log_rule["actions"][0]["tags"] = destination_version.split(",")
-                self._queue.append(log_rule)                
-                if self.debug:
-                    print '%s - %s' % ('log_rule', str(log_rule))
+                    "headers": {
+                        self.header: self.pattern
+                    }
+                },
+                "actions": [
+                    {
+                        "action": "trace",
+                        "log_key": "gremlin_recipe_id",
+                        "log_value": self._id
+                    }
+                ]
+            }
+            if source_version:
+                log_rule["match"]["source"]["tags"] = source_version.split(",")
+            if destination_version:
+                log_rule["actions"][0]["tags"] = destination_version.split(",")
+            self._queue.append(log_rule)                
+            if self.debug:
+                print '%s - %s' % ('log_rule', str(log_rule))
 
 
     def _generate_rules(self, rtype, **args):
@@ -368,13 +428,24 @@ class A8FailureGenerator(object):
         self.abort_requests(**rule)
 
     """
-    Causes the dest service to become unavailable to all callers
+    Causes the dest service to become unavailable to all callers.
+    With scope 'transitive', every service that calls dest, directly or
+    indirectly, crashes as well, to reproduce a cascading failure.
     """
     def crash_service(self, **args):
         rule = args.copy()
-        rule['source']=''
+        assert 'dest' in rule and rule['dest'] != ""
+        rule.pop('source', None) # abort the requests of all callers
+        scope = rule.pop('scope', 'direct') or 'direct'
+        assert scope in ('direct', 'transitive')
         rule['errorcode']=rule.pop('errorcode', 0) or 0
-        self.abort_requests(**rule)
+
+        services = [rule['dest']]
+        if scope == 'transitive':
+            services.extend(self.app.get_upstream(rule['dest']))
+        for service in services:
+            rule['dest'] = service
+            self.abort_requests(**rule)
 
     def setup_failure(self, scenario=None, **args):
         """Add a given failure scenario
@@ -387,10 +458,8 @@ class A8FailureGenerator(object):
         """Add gremlins to environment"""
 
         assert isinstance(gremlins, dict) and 'gremlins' in gremlins
-        graph = self.app._get_networkX()
         ##color edges initially
-        for e in graph.edges():
-            graph[e[0]][e[1]]['color'] = 'black'
+        self.app.set_edge_colors('black')
 
         for gremlin in gremlins['gremlins']:
             self.setup_failure(**gremlin)
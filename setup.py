@@ -34,10 +34,13 @@ setup(
         "parse",
         "prettytable",
         "decorator",
-        'networkx',
         'elasticsearch==2.4.0',
         'elasticsearch_dsl==2.1.0',
         'isodate'
     ],
+    extras_require={
+        # for ApplicationGraph.to_networkx() and from_networkx()
+        'networkx': ['networkx']
+    },
     license='Apache Software License V2'
 )